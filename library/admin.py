@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Author, Genre, Book, Favorite
+from .models import Author, Genre, Book, Favorite, ChunkedUpload, FavoriteRollup
 
 @admin.register(Author)
 class AuthorAdmin(admin.ModelAdmin):
@@ -34,6 +34,9 @@ class BookAdmin(admin.ModelAdmin):
         }),
     ]
     
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related('genres')
+
     def display_genres(self, obj):
         """Отображает жанры в списке книг"""
         return ", ".join([genre.name for genre in obj.genres.all()])
@@ -51,4 +54,19 @@ class FavoriteAdmin(admin.ModelAdmin):
     list_filter = ['added_at', 'user']
     search_fields = ['user__username', 'book__title']
     list_per_page = 20
-    date_hierarchy = 'added_at'
\ No newline at end of file
+    date_hierarchy = 'added_at'
+
+@admin.register(ChunkedUpload)
+class ChunkedUploadAdmin(admin.ModelAdmin):
+    list_display = ['filename', 'book', 'user', 'offset', 'total_size', 'status', 'updated_at']
+    list_filter = ['status']
+    search_fields = ['filename', 'book__title']
+    list_per_page = 20
+
+@admin.register(FavoriteRollup)
+class FavoriteRollupAdmin(admin.ModelAdmin):
+    list_display = ['book', 'day', 'adds', 'removes']
+    list_filter = ['day']
+    search_fields = ['book__title']
+    list_per_page = 20
+    date_hierarchy = 'day'
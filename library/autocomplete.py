@@ -0,0 +1,109 @@
+"""Подсказки для поиска по префиксу названия книги или имени автора.
+
+Индекс живет в памяти процесса: отсортированный список нормализованных
+суффиксов, начинающихся с каждого слова, и номер записи для каждого из них.
+Поиск - двоичный поиск по префиксу, база при этом не используется. Индекс
+перестраивается, когда меняется версия каталога из library.caching; она
+общая для всех процессов, поэтому изменение в одном воркере видят все.
+"""
+import re
+import threading
+from bisect import bisect_left
+from array import array
+
+from django.db import DatabaseError, connections
+from django.urls import reverse
+
+from .caching import get_catalog_version
+
+SUGGESTIONS_LIMIT = 8
+MAX_SCANNED_KEYS = 200
+
+WORD_START_RE = re.compile(r'(?<!\w)\w')
+SPACES_RE = re.compile(r'\s+')
+
+
+def normalize(text):
+    """Приводит строку к виду для сравнения: регистр, ё/е и пробелы"""
+    return SPACES_RE.sub(' ', text.casefold().replace('ё', 'е')).strip()
+
+
+class PrefixIndex:
+    def __init__(self, entries):
+        self.entries = entries
+        self.labels = [normalize(label) for label, _kind, _url in entries]
+        pairs = []
+        for number, text in enumerate(self.labels):
+            for match in WORD_START_RE.finditer(text):
+                pairs.append((text[match.start():], number))
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.owners = array('I', (number for _, number in pairs))
+
+    def search(self, query, limit=SUGGESTIONS_LIMIT):
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        found = []
+        seen = set()
+        position = bisect_left(self.keys, prefix)
+        end = min(len(self.keys), position + MAX_SCANNED_KEYS)
+        while position < end and self.keys[position].startswith(prefix):
+            number = self.owners[position]
+            if number not in seen:
+                seen.add(number)
+                # Совпадение с начала строки важнее совпадения с середины
+                whole = self.labels[number].startswith(prefix)
+                found.append((not whole, len(self.labels[number]), number))
+            position += 1
+
+        found.sort()
+        return [self.entries[number] for _, _, number in found[:limit]]
+
+
+def build_index():
+    from .models import Author, Book
+    entries = [
+        (title, 'book', reverse('book_detail', args=[pk]))
+        for pk, title in Book.objects.values_list('pk', 'title')
+    ]
+    entries += [
+        (name, 'author', reverse('book_list') + f'?author={pk}')
+        for pk, name in Author.objects.values_list('pk', 'name')
+    ]
+    return PrefixIndex(entries)
+
+
+_lock = threading.Lock()
+_index = None
+_generation = None
+
+
+def get_index():
+    """Возвращает индекс, перестраивая его при смене версии каталога"""
+    global _index, _generation
+    generation = get_catalog_version()
+    if _index is None or generation != _generation:
+        with _lock:
+            if _index is None or generation != _generation:
+                _index = build_index()
+                _generation = generation
+    return _index
+
+
+def suggest(query, limit=SUGGESTIONS_LIMIT):
+    return [
+        {'label': label, 'kind': kind, 'url': url}
+        for label, kind, url in get_index().search(query, limit)
+    ]
+
+
+def warm_up():
+    """Строит индекс при старте процесса, если база уже доступна"""
+    try:
+        get_index()
+    except DatabaseError:
+        pass
+    finally:
+        connections.close_all()
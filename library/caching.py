@@ -0,0 +1,110 @@
+"""Условные ответы и кэш страниц каталога для анонимных посетителей.
+
+Версия каталога - время последнего изменения книг, авторов или жанров в
+микросекундах. Она хранится в маленьком файле CATALOG_VERSION_PATH, общем
+для всех процессов сервера и команд управления, поэтому ETag и
+Last-Modified вычисляются без запросов к базе, а изменение в любом
+процессе делает старые страницы в кэше каждого процесса недостижимыми.
+"""
+import hashlib
+import os
+import tempfile
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Max
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+PAGE_CACHE_PREFIX = 'library:page'
+
+
+def _read_version(path):
+    try:
+        with open(path, encoding='ascii') as version_file:
+            return int(version_file.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_version(path, version, replace=True):
+    """Атомарно пишет версию; без replace - только если файла еще нет"""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.version-')
+    try:
+        with os.fdopen(fd, 'w', encoding='ascii') as version_file:
+            version_file.write(str(version))
+        if replace:
+            os.replace(temp_path, path)
+        else:
+            try:
+                os.link(temp_path, path)
+            except FileExistsError:
+                pass
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def get_catalog_version():
+    path = settings.CATALOG_VERSION_PATH
+    version = _read_version(path)
+    if version is None:
+        from .models import Book
+        latest = Book.objects.aggregate(latest=Max('updated_at'))['latest']
+        # Не перезаписываем версию, которую успел поднять другой процесс
+        _write_version(path, int(latest.timestamp() * 1000000) if latest else 0, replace=False)
+        version = _read_version(path) or 0
+    return version
+
+
+def bump_catalog_version():
+    """Отмечает изменение каталога: старые ETag и страницы в кэше устаревают"""
+    path = settings.CATALOG_VERSION_PATH
+    version = int(time.time() * 1000000)
+    previous = _read_version(path) or 0
+    _write_version(path, max(version, previous + 1))
+
+
+def is_anonymous_request(request):
+    # Проверяем только наличие cookie сессии, чтобы не загружать сессию из базы
+    return settings.SESSION_COOKIE_NAME not in request.COOKIES
+
+
+def page_cache_key(request, version):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    return f'{PAGE_CACHE_PREFIX}:{version}:{request.method}:{path}'
+
+
+def catalog_page(view_func):
+    """Отвечает 304 по версии каталога и кэширует страницы для анонимов"""
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or not is_anonymous_request(request):
+            return view_func(request, *args, **kwargs)
+
+        version = get_catalog_version()
+        etag = quote_etag(f'{version:x}')
+        last_modified = version // 1000000
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+
+        key = page_cache_key(request, version)
+        response = cache.get(key)
+        if response is None:
+            response = view_func(request, *args, **kwargs)
+            if (response.status_code != 200 or response.streaming or response.cookies
+                    or request.META.get('CSRF_COOKIE_USED')):
+                return response
+            response['ETag'] = etag
+            response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ['Cookie'])
+            patch_cache_control(response, max_age=0)
+            cache.set(key, response, settings.CATALOG_PAGE_CACHE_TIMEOUT)
+        return response
+    return wrapper
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from library.similarity import SIMILAR_BOOKS_COUNT, rebuild_similar_books
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает таблицу похожих книг для всего каталога'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--count', type=int, default=SIMILAR_BOOKS_COUNT,
+            help='Сколько похожих книг хранить для каждой книги',
+        )
+
+    def handle(self, *args, **options):
+        total = rebuild_similar_books(k=options['count'])
+        self.stdout.write(self.style.SUCCESS(f'Сохранено связей: {total}'))
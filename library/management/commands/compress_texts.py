@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from library.models import Book
+from library.textstore import compressed_copy
+
+
+class Command(BaseCommand):
+    help = 'Переводит текстовые книги, загруженные до появления сжатия, в сжатый формат'
+
+    def handle(self, *args, **options):
+        compressed = 0
+        for book in Book.objects.filter(book_file__iendswith='.txt').iterator():
+            try:
+                # Старый файл освободится счетчиком ссылок при сохранении
+                book.book_file = compressed_copy(book.book_file)
+                book.save(update_fields=['book_file'])
+                compressed += 1
+            except Exception as error:
+                self.stderr.write(f'Книга {book.pk}: {error}')
+        self.stdout.write(self.style.SUCCESS(f'Сжато книг: {compressed}'))
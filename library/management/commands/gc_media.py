@@ -0,0 +1,119 @@
+import os
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from library.models import Book, BookPage, ChunkedUpload, StoredFile
+from library.storage import LOCK_NAME, TEMP_PREFIX, book_storage, iter_media_files
+
+
+class Command(BaseCommand):
+    help = 'Находит в MEDIA_ROOT файлы, на которые не ссылается ни одна книга, и брошенные загрузки по частям'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete', action='store_true',
+            help='Удалить найденные файлы (по умолчанию только вывести список)',
+        )
+        parser.add_argument(
+            '--temp-age', type=int, default=3600,
+            help='Возраст в секундах, после которого недокачанные временные файлы считаются мусором',
+        )
+        parser.add_argument(
+            '--upload-age', type=int, default=settings.CHUNKED_UPLOAD_EXPIRY,
+            help='Сколько секунд без новых частей незавершенная загрузка по частям считается брошенной',
+        )
+
+    def referenced_names(self):
+        names = set()
+        rows = Book.objects.values_list(*Book.STORED_FILE_FIELDS).iterator()
+        for row in rows:
+            names.update(name for name in row if name)
+        names.update(BookPage.objects.values_list('image', flat=True).iterator())
+        names.update(
+            StoredFile.objects.filter(ref_count__gt=0).values_list('name', flat=True).iterator()
+        )
+        return names
+
+    def handle(self, *args, **options):
+        referenced = self.referenced_names()
+        temp_deadline = time.time() - options['temp_age']
+        orphans = 0
+        freed = 0
+
+        for name, entry in iter_media_files(settings.MEDIA_ROOT, skip_prefixes=()):
+            if entry.name == LOCK_NAME:
+                continue
+            if entry.name.startswith(TEMP_PREFIX):
+                if entry.stat().st_mtime > temp_deadline:
+                    continue
+            elif name in referenced:
+                continue
+
+            size = entry.stat().st_size
+            orphans += 1
+            freed += size
+            self.stdout.write(f'{name} ({size} байт)')
+            if options['delete']:
+                with book_storage.lock():
+                    # Файл могли взять уже после того, как собрали список ссылок
+                    if not StoredFile.objects.filter(name=name, ref_count__gt=0).exists():
+                        os.remove(entry.path)
+
+        if options['delete']:
+            unused = StoredFile.objects.filter(ref_count=0).values_list('name', flat=True)
+            StoredFile.objects.filter(
+                name__in=[name for name in unused if name not in referenced]
+            ).delete()
+
+        uploads, upload_bytes = self.collect_uploads(options['upload_age'], options['delete'])
+
+        action = 'Удалено' if options['delete'] else 'Найдено'
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} файлов без ссылок: {orphans}, {freed} байт; '
+            f'брошенных загрузок: {uploads}, {upload_bytes} байт'
+        ))
+
+    def collect_uploads(self, age, delete):
+        """Незавершенные загрузки без новых частей дольше age секунд и .part без загрузки"""
+        deadline = time.time() - age
+        stale = ChunkedUpload.objects.filter(
+            status=ChunkedUpload.STATUS_UPLOADING,
+            updated_at__lt=timezone.now() - timedelta(seconds=age),
+        )
+        count = size = 0
+        for upload in stale.iterator():
+            try:
+                stat = os.stat(upload.temp_path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and stat.st_mtime > deadline:
+                continue
+            count += 1
+            size += stat.st_size if stat else 0
+            self.stdout.write(f'загрузка {upload.upload_id}: {upload.filename} ({upload.offset}/{upload.total_size} байт)')
+            if delete:
+                if stat is not None:
+                    os.remove(upload.temp_path)
+                upload.delete()
+
+        if not os.path.isdir(settings.CHUNKED_UPLOAD_DIR):
+            return count, size
+        active = {
+            f'{upload_id}.part' for upload_id in ChunkedUpload.objects.filter(
+                status=ChunkedUpload.STATUS_UPLOADING,
+            ).values_list('upload_id', flat=True).iterator()
+        }
+        with os.scandir(settings.CHUNKED_UPLOAD_DIR) as entries:
+            for entry in entries:
+                if entry.name in active or not entry.is_file() or entry.stat().st_mtime > deadline:
+                    continue
+                count += 1
+                size += entry.stat().st_size
+                self.stdout.write(f'{entry.path} ({entry.stat().st_size} байт)')
+                if delete:
+                    os.remove(entry.path)
+        return count, size
@@ -0,0 +1,497 @@
+import asyncio
+import ctypes
+import http.client
+import io
+import itertools
+import os
+import random
+import socketserver
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.cookies import SimpleCookie
+from urllib.parse import quote, urlsplit
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError
+from django.db.backends.signals import connection_created
+from django.middleware.csrf import CSRF_ALLOWED_CHARS, CSRF_TOKEN_LENGTH
+from django.urls import URLPattern, URLResolver, Resolver404, resolve, reverse
+from django.utils.crypto import get_random_string
+
+from library import urls as library_urls
+from library.models import Author, Book, Genre
+
+# Доли маршрутов в синтетической нагрузке; остальные маршруты получают вес 1
+ROUTE_WEIGHTS = {
+    'home': 20,
+    'book_list': 20,
+    'book_detail': 25,
+    'read_book': 10,
+    'autocomplete': 15,
+    'login': 3,
+    'register': 2,
+}
+# Маршруты, которые меняют данные или завершают сессию: в синтетической
+# нагрузке их нет, при необходимости их можно дать через --mix с телом запроса
+EXCLUDED_ROUTES = {
+    'logout', 'toggle_favorite', 'favorites_batch', 'upload_start', 'upload_chunk', 'upload_complete',
+}
+SEARCH_WORDS = ['мас', 'гор', 'тол', 'пушкин', 'Роман', 'ду', 'отцы', 'сердце']
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+# Паузы обработчика занятости, как у sqlite3_busy_timeout, в миллисекундах
+BUSY_DELAYS = (1, 2, 5, 10, 15, 20, 25, 25, 25, 50, 50, 100)
+BUSY_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.c_int)
+
+
+def sqlite_library():
+    """libsqlite3, с которой работает модуль sqlite3, или None"""
+    if sys.implementation.name != 'cpython':
+        return None
+    try:
+        import _sqlite3
+        library = ctypes.CDLL(_sqlite3.__file__)
+        library.sqlite3_busy_handler.argtypes = [ctypes.c_void_p, BUSY_HANDLER, ctypes.c_void_p]
+        library.sqlite3_db_filename.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
+        library.sqlite3_db_filename.restype = ctypes.c_char_p
+    except (ImportError, OSError, AttributeError):
+        return None
+    return library
+
+
+class QueryTimer:
+    """Считает время запросов к базе, медленные запросы, ожидания и ошибки блокировки SQLite
+
+    Ожидания блокировки считает собственный обработчик занятости SQLite,
+    который ставится вместо busy timeout с теми же паузами и тем же пределом.
+    """
+
+    def __init__(self, slow_ms):
+        self.slow = slow_ms / 1000
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.total = 0.0
+        self.slow_count = 0
+        self.slow_total = 0.0
+        self.locked_errors = 0
+        self.lock_waits = 0
+        self.lock_wait_total = 0.0
+        self.lock_waits_measured = None
+        self.sqlite = sqlite_library()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as error:
+            if 'locked' in str(error):
+                with self.lock:
+                    self.locked_errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.queries += 1
+                self.total += elapsed
+                if elapsed >= self.slow:
+                    self.slow_count += 1
+                    self.slow_total += elapsed
+
+    def busy_handler(self, timeout):
+        started = []
+
+        def handler(argument, count):
+            now = time.perf_counter()
+            if count == 0:
+                started[:] = [now]
+                with self.lock:
+                    self.lock_waits += 1
+            if now - started[0] >= timeout:
+                return 0
+            delay = min(BUSY_DELAYS[min(count, len(BUSY_DELAYS) - 1)] / 1000, timeout - (now - started[0]))
+            time.sleep(delay)
+            with self.lock:
+                self.lock_wait_total += delay
+            return 1
+        return BUSY_HANDLER(handler)
+
+    def install_busy_handler(self, connection):
+        raw = connection.connection
+        # Указатель sqlite3* - первое поле объекта соединения после PyObject_HEAD
+        db = ctypes.c_void_p.from_address(id(raw) + object.__basicsize__).value
+        if db is None:
+            return False
+        # Проверка, что указатель действительно на соединение с базой проекта
+        filename = os.fsdecode(self.sqlite.sqlite3_db_filename(db, b'main') or b'')
+        if not filename or os.path.realpath(filename) != os.path.realpath(connection.settings_dict['NAME']):
+            return False
+        handler = self.busy_handler(connection.settings_dict['OPTIONS'].get('timeout', 5))
+        # Обработчик должен жить, пока открыто соединение
+        connection.loadtest_busy_handler = handler
+        self.sqlite.sqlite3_busy_handler(db, handler, None)
+        return True
+
+    def install(self, sender, connection, **kwargs):
+        if self not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self)
+        if connection.vendor == 'sqlite':
+            measured = self.sqlite is not None and self.install_busy_handler(connection)
+            with self.lock:
+                # Ожидания измерены, только если обработчик стоит на каждом соединении
+                self.lock_waits_measured = measured and self.lock_waits_measured is not False
+
+
+class ThreadingWSGIServer(socketserver.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный прогон: конкурентные запросы к WSGI/ASGI приложению в процессе '
+        'или к локальному серверу с отчетом о пропускной способности и задержках'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['wsgi', 'asgi', 'server'], default='wsgi',
+                            help='wsgi/asgi - вызывать приложение в процессе, server - через HTTP')
+        parser.add_argument('--url', help='Адрес уже запущенного сервера для --target server; '
+                                          'без него поднимается локальный сервер в процессе')
+        parser.add_argument('--concurrency', type=int, default=8, help='Число одновременных клиентов')
+        parser.add_argument('--requests', type=int, default=1000, help='Сколько запросов отправить')
+        parser.add_argument('--duration', type=float, help='Длительность прогона в секундах вместо --requests')
+        parser.add_argument('--mix', help='Файл с записанным трафиком: по строке "METHOD /path?query [тело]" '
+                                         'на запрос, тело - данные формы в urlencoded; только так в нагрузку '
+                                         'попадают маршруты, меняющие данные')
+        parser.add_argument('--cookie', default='', help='Заголовок Cookie для всех запросов; csrftoken '
+                                                         'добавляется сам, если его нет')
+        parser.add_argument('--seed', type=int, default=1, help='Зерно генератора синтетической нагрузки')
+        parser.add_argument('--slow-query-ms', type=float, default=50,
+                            help='Порог в миллисекундах, после которого запрос к базе считается медленным')
+
+    # Нагрузка
+
+    def recorded_mix(self, path):
+        requests = []
+        with open(path, encoding='utf-8') as mix_file:
+            for line in mix_file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                parts = line.split(None, 2)
+                if len(parts) == 1:
+                    parts = ['GET'] + parts
+                method, target, body = (parts + [''])[:3]
+                target = quote(target, safe="/?=&%:+,;@")
+                requests.append((self.route_name(target), method.upper(), target, body.encode()))
+        if not requests:
+            raise CommandError(f'В файле {path} нет запросов')
+        return itertools.cycle(requests)
+
+    def route_name(self, target):
+        try:
+            return resolve(urlsplit(target).path).url_name or 'unnamed'
+        except Resolver404:
+            return 'not_found'
+
+    def synthetic_mix(self, seed):
+        """Бесконечный поток запросов к маршрутам library.urls по весам, кроме изменяющих данные"""
+        book_ids = list(Book.objects.values_list('pk', flat=True)) or [1]
+        genre_ids = list(Genre.objects.values_list('pk', flat=True)) or [1]
+        author_ids = list(Author.objects.values_list('pk', flat=True)) or [1]
+        routes = [
+            pattern.name for pattern in self.iter_patterns(library_urls.urlpatterns)
+            if pattern.name and pattern.name not in EXCLUDED_ROUTES
+        ]
+        weights = [ROUTE_WEIGHTS.get(name, 1) for name in routes]
+        rng = random.Random(seed)
+
+        def build(name):
+            pattern = self.patterns[name]
+            kwargs = {}
+            for key, converter in pattern.pattern.converters.items():
+                if converter.regex == '[0-9]+':
+                    kwargs[key] = rng.choice(book_ids)
+                else:
+                    kwargs[key] = uuid.uuid4()
+            path = reverse(name, kwargs=kwargs)
+            if name == 'book_list':
+                query = rng.choice([
+                    '', f'?genre={rng.choice(genre_ids)}', f'?author={rng.choice(author_ids)}',
+                    f'?q={rng.choice(SEARCH_WORDS)}',
+                ])
+                path += query
+            elif name == 'autocomplete':
+                path += f'?q={rng.choice(SEARCH_WORDS)[:rng.randint(1, 3)]}'
+            return quote(path, safe='/?=&')
+
+        def generate():
+            while True:
+                name = rng.choices(routes, weights)[0]
+                yield name, 'GET', build(name), b''
+        return generate()
+
+    def iter_patterns(self, patterns):
+        for pattern in patterns:
+            if isinstance(pattern, URLResolver):
+                yield from self.iter_patterns(pattern.url_patterns)
+            elif isinstance(pattern, URLPattern):
+                yield pattern
+
+    # Клиенты
+
+    def request_headers(self, cookie):
+        """Cookie и заголовок CSRF, с которыми формы проходят CsrfViewMiddleware"""
+        jar = SimpleCookie()
+        jar.load(cookie)
+        if settings.CSRF_COOKIE_NAME in jar:
+            token = jar[settings.CSRF_COOKIE_NAME].value
+        else:
+            token = get_random_string(CSRF_TOKEN_LENGTH, allowed_chars=CSRF_ALLOWED_CHARS)
+            cookie = '; '.join(filter(None, [cookie, f'{settings.CSRF_COOKIE_NAME}={token}']))
+        csrf_header = settings.CSRF_HEADER_NAME[len('HTTP_'):].replace('_', '-').title()
+        return {'Cookie': cookie, csrf_header: token}
+
+    def wsgi_call(self, application, headers):
+        def call(method, target, body):
+            path, _, query = target.partition('?')
+            environ = {
+                'REQUEST_METHOD': method,
+                'PATH_INFO': path,
+                'QUERY_STRING': query,
+                'SERVER_NAME': 'localhost',
+                'SERVER_PORT': '80',
+                'SERVER_PROTOCOL': 'HTTP/1.1',
+                'HTTP_HOST': 'localhost',
+                'REMOTE_ADDR': '127.0.0.1',
+                'CONTENT_LENGTH': str(len(body)),
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.input': io.BytesIO(body),
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+            if body:
+                environ['CONTENT_TYPE'] = FORM_CONTENT_TYPE
+            for name, value in headers.items():
+                environ['HTTP_' + name.upper().replace('-', '_')] = value
+            status = []
+            result = application(environ, lambda code, headers, exc_info=None: status.append(code))
+            try:
+                for _ in result:
+                    pass
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            return int(status[0].split()[0])
+        return call
+
+    def http_call(self, base_url, headers):
+        parts = urlsplit(base_url)
+
+        def call(method, target, body):
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=30)
+            try:
+                request_headers = dict(headers, Host=parts.netloc)
+                if body:
+                    request_headers['Content-Type'] = FORM_CONTENT_TYPE
+                connection.request(method, target, body=body, headers=request_headers)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            finally:
+                connection.close()
+        return call
+
+    def run_threads(self, call, source, options):
+        results = []
+        lock = threading.Lock()
+        deadline = time.perf_counter() + options['duration'] if options['duration'] else None
+        remaining = itertools.count()
+
+        def worker():
+            while True:
+                with lock:
+                    if deadline is None and next(remaining) >= options['requests']:
+                        return
+                    route, method, target, body = next(source)
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                start = time.perf_counter()
+                try:
+                    status = call(method, target, body)
+                except Exception as error:
+                    status = 0
+                    self.remember_error(route, error)
+                elapsed = time.perf_counter() - start
+                with lock:
+                    results.append((route, status, elapsed))
+
+        with ThreadPoolExecutor(options['concurrency']) as pool:
+            for _ in range(options['concurrency']):
+                pool.submit(worker)
+        return results
+
+    async def run_asgi(self, application, source, headers, options):
+        results = []
+        deadline = time.perf_counter() + options['duration'] if options['duration'] else None
+        remaining = itertools.count()
+        common_headers = [(b'host', b'localhost')] + [
+            (name.lower().encode(), value.encode()) for name, value in headers.items()
+        ]
+
+        async def call(method, target, body):
+            path, _, query = target.partition('?')
+            request_headers = common_headers + [(b'content-length', str(len(body)).encode())]
+            if body:
+                request_headers.append((b'content-type', FORM_CONTENT_TYPE.encode()))
+            scope = {
+                'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+                'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+                'query_string': query.encode(), 'root_path': '', 'headers': request_headers,
+                'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+            }
+            status = []
+
+            async def receive():
+                return {'type': 'http.request', 'body': body, 'more_body': False}
+
+            async def send(message):
+                if message['type'] == 'http.response.start':
+                    status.append(message['status'])
+
+            await application(scope, receive, send)
+            return status[0]
+
+        async def worker():
+            while True:
+                if deadline is None and next(remaining) >= options['requests']:
+                    return
+                if deadline is not None and time.perf_counter() >= deadline:
+                    return
+                route, method, target, body = next(source)
+                start = time.perf_counter()
+                try:
+                    status = await call(method, target, body)
+                except Exception as error:
+                    status = 0
+                    self.remember_error(route, error)
+                results.append((route, status, time.perf_counter() - start))
+
+        await asyncio.gather(*(worker() for _ in range(options['concurrency'])))
+        return results
+
+    def remember_error(self, route, error):
+        self.failures.setdefault(f'{route}: {error.__class__.__name__}: {error}', 0)
+        self.failures[f'{route}: {error.__class__.__name__}: {error}'] += 1
+
+    # Запуск и отчет
+
+    def handle(self, *args, **options):
+        self.failures = {}
+        source = self.recorded_mix(options['mix']) if options['mix'] else None
+        self.patterns = {
+            pattern.name: pattern for pattern in self.iter_patterns(library_urls.urlpatterns) if pattern.name
+        }
+        if source is None:
+            source = self.synthetic_mix(options['seed'])
+
+        headers = self.request_headers(options['cookie'])
+        timer = QueryTimer(options['slow_query_ms'])
+        connection_created.connect(timer.install)
+        server = None
+        try:
+            started = time.perf_counter()
+            if options['target'] == 'asgi':
+                from online_library.asgi import application
+                results = asyncio.run(self.run_asgi(application, source, headers, options))
+            elif options['target'] == 'server':
+                base_url = options['url']
+                if not base_url:
+                    from online_library.wsgi import application
+                    server = make_server('127.0.0.1', 0, application,
+                                         server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+                    threading.Thread(target=server.serve_forever, daemon=True).start()
+                    base_url = f'http://localhost:{server.server_port}'
+                    started = time.perf_counter()
+                results = self.run_threads(self.http_call(base_url, headers), source, options)
+            else:
+                from online_library.wsgi import application
+                results = self.run_threads(self.wsgi_call(application, headers), source, options)
+            wall = time.perf_counter() - started
+        finally:
+            connection_created.disconnect(timer.install)
+            if server is not None:
+                server.shutdown()
+
+        self.report(results, wall, timer, options)
+
+    def report(self, results, wall, timer, options):
+        if not results:
+            raise CommandError('Не выполнено ни одного запроса')
+
+        latencies = sorted(elapsed for _, _, elapsed in results)
+        server_errors = sum(1 for _, status, _ in results if status == 0 or status >= 500)
+        client_errors = sum(1 for _, status, _ in results if 400 <= status < 500)
+        errors = server_errors + client_errors
+        write = self.stdout.write
+
+        write(f"Цель: {options['target']}, клиентов: {options['concurrency']}")
+        write(f'Запросов: {len(results)} за {wall:.2f} с, {len(results) / wall:.1f} запр/с')
+        write(f'Ошибок: {errors} ({100 * errors / len(results):.2f}%): '
+              f'5xx и сбои - {server_errors}, 4xx - {client_errors}')
+        write('Задержка, мс: ' + ', '.join(
+            f'p{int(fraction * 100)}={1000 * percentile(latencies, fraction):.1f}'
+            for fraction in (0.5, 0.9, 0.95, 0.99)
+        ) + f', max={1000 * latencies[-1]:.1f}')
+
+        if timer.queries:
+            if timer.lock_waits_measured:
+                waits = f'ожиданий блокировки SQLite: {timer.lock_waits} на {timer.lock_wait_total:.2f} с; '
+            elif timer.lock_waits_measured is False:
+                waits = 'ожидания блокировки SQLite не измерены; '
+            else:
+                waits = ''
+            write(
+                f'База: {timer.queries} запросов, {timer.total:.2f} с; '
+                f'медленных (дольше {options["slow_query_ms"]:.0f} мс): '
+                f'{timer.slow_count} на {timer.slow_total:.2f} с; '
+                f'{waits}ошибок "database is locked": {timer.locked_errors}'
+            )
+
+        for message, count in sorted(self.failures.items(), key=lambda item: -item[1])[:5]:
+            write(self.style.ERROR(f'  {count} x {message}'))
+
+        by_route = defaultdict(list)
+        statuses = defaultdict(lambda: defaultdict(int))
+        for route, status, elapsed in results:
+            by_route[route].append(elapsed)
+            statuses[route][status] += 1
+
+        write('')
+        write(f'{"Маршрут":<20} {"запросов":>9} {"p50, мс":>9} {"p95, мс":>9}  статусы')
+        for route in sorted(by_route, key=lambda name: -len(by_route[name])):
+            values = sorted(by_route[route])
+            codes = ' '.join(f'{code}:{count}' for code, count in sorted(statuses[route].items()))
+            write(
+                f'{route:<20} {len(values):>9} {1000 * percentile(values, 0.5):>9.1f} '
+                f'{1000 * percentile(values, 0.95):>9.1f}  {codes}'
+            )
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from library.models import Book
+from library.pdf import process_book_pdf
+
+
+class Command(BaseCommand):
+    help = 'Готовит PDF книг к быстрому чтению: линеаризация и превью первых страниц'
+
+    def handle(self, *args, **options):
+        books = Book.objects.filter(book_file__iendswith='.pdf').exclude(processed_file=F('book_file'))
+        processed = 0
+        for book_id in books.values_list('pk', flat=True):
+            try:
+                if process_book_pdf(book_id):
+                    processed += 1
+            except Exception as error:
+                self.stderr.write(f'Книга {book_id}: {error}')
+        self.stdout.write(self.style.SUCCESS(f'Обработано книг: {processed}'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from library.caching import bump_catalog_version
+from library.rollups import rollup_favorites
+
+
+class Command(BaseCommand):
+    help = 'Добавляет новые события избранного в дневную статистику для трендов'
+
+    def handle(self, *args, **options):
+        adds, removes = rollup_favorites()
+        if adds or removes:
+            bump_catalog_version()
+        self.stdout.write(self.style.SUCCESS(
+            f'Учтено добавлений: {adds}, удалений: {removes}'
+        ))
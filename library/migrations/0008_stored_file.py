@@ -0,0 +1,37 @@
+# Generated by Django 3.2.12 on 2026-10-19 11:53
+
+from django.db import migrations, models
+import library.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0007_auto_20251217_1543'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True, verbose_name='Путь к файлу')),
+                ('ref_count', models.PositiveIntegerField(default=0, verbose_name='Количество ссылок')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Файл хранилища',
+                'verbose_name_plural': 'Файлы хранилища',
+            },
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='book_file',
+            field=models.FileField(blank=True, null=True, storage=library.storage.ContentAddressedStorage(), upload_to='books/'),
+        ),
+        migrations.AlterField(
+            model_name='book',
+            name='cover',
+            field=models.ImageField(blank=True, null=True, storage=library.storage.ContentAddressedStorage(), upload_to='covers/'),
+        ),
+    ]
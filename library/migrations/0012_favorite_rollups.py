@@ -0,0 +1,50 @@
+# Generated by Django 3.2.12 on 2026-10-19 11:57
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0011_book_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='FavoriteRemoval',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('favorite_id', models.BigIntegerField(verbose_name='Удаленная запись избранного')),
+                ('removed_at', models.DateTimeField(auto_now_add=True, verbose_name='Дата удаления')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='library.book', verbose_name='Книга')),
+            ],
+            options={
+                'verbose_name': 'Удаление из избранного',
+                'verbose_name_plural': 'Удаления из избранного',
+            },
+        ),
+        migrations.CreateModel(
+            name='FavoriteRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True, verbose_name='День')),
+                ('adds', models.PositiveIntegerField(default=0, verbose_name='Добавлений')),
+                ('removes', models.PositiveIntegerField(default=0, verbose_name='Удалений')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='library.book', verbose_name='Книга')),
+            ],
+            options={
+                'verbose_name': 'Статистика избранного за день',
+                'verbose_name_plural': 'Статистика избранного по дням',
+                'unique_together': {('book', 'day')},
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 3.2.12 on 2026-10-19 12:00
+
+from django.db import migrations, models
+import django.db.models.deletion
+import library.storage
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0012_favorite_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='processed_file',
+            field=models.CharField(blank=True, editable=False, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='web_file',
+            field=models.FileField(blank=True, editable=False, null=True, storage=library.storage.ContentAddressedStorage(), upload_to='books/', verbose_name='PDF для быстрого просмотра'),
+        ),
+        migrations.CreateModel(
+            name='BookPage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveSmallIntegerField(verbose_name='Номер страницы')),
+                ('image', models.ImageField(storage=library.storage.ContentAddressedStorage(), upload_to='pages/', verbose_name='Изображение')),
+                ('width', models.PositiveIntegerField(default=0)),
+                ('height', models.PositiveIntegerField(default=0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pages', to='library.book', verbose_name='Книга')),
+            ],
+            options={
+                'verbose_name': 'Страница книги',
+                'verbose_name_plural': 'Страницы книг',
+                'ordering': ['number'],
+                'unique_together': {('book', 'number')},
+            },
+        ),
+    ]
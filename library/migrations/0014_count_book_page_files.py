@@ -0,0 +1,34 @@
+from django.db import migrations
+from django.db.models import Count, F
+
+from library.storage import is_hashed_name
+
+
+def count_book_page_files(apps, schema_editor):
+    """Ссылки страниц-превью, созданных до того, как для них завели счетчик"""
+    BookPage = apps.get_model('library', 'BookPage')
+    StoredFile = apps.get_model('library', 'StoredFile')
+    for row in BookPage.objects.values('image').annotate(pages=Count('id')):
+        if is_hashed_name(row['image']):
+            StoredFile.objects.get_or_create(name=row['image'])
+            StoredFile.objects.filter(name=row['image']).update(ref_count=F('ref_count') + row['pages'])
+
+
+def uncount_book_page_files(apps, schema_editor):
+    BookPage = apps.get_model('library', 'BookPage')
+    StoredFile = apps.get_model('library', 'StoredFile')
+    for row in BookPage.objects.values('image').annotate(pages=Count('id')):
+        StoredFile.objects.filter(name=row['image'], ref_count__gte=row['pages']).update(
+            ref_count=F('ref_count') - row['pages']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('library', '0013_book_pages'),
+    ]
+
+    operations = [
+        migrations.RunPython(count_book_page_files, uncount_book_page_files),
+    ]
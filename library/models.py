@@ -1,12 +1,21 @@
+import logging
+import os
+import uuid
+from django.conf import settings
 from django.db import models
+from django.db.models.fields.files import FieldFile
 from django.contrib.auth.models import User
 from django.urls import reverse
-from django.db.models.signals import post_save
+from django.db.models.signals import pre_save, post_save, post_init, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
 from django.core.validators import RegexValidator
 from django.utils import timezone
-from datetime import date
-from django.db.models import Count, Q
+from datetime import date, timedelta
+from django.db.models import Count, Q, F, Sum
+from django.db import transaction
+from .storage import book_storage, is_hashed_name
+
+logger = logging.getLogger(__name__)
 
 class Author(models.Model):
     name = models.CharField(max_length=100, verbose_name="Имя автора")
@@ -29,14 +38,42 @@ class Genre(models.Model):
         verbose_name_plural = "Жанры"
 
 
-class Book(models.Model):
+class StoredFilesMixin:
+    """Модель с файлами в хранилище по хэшу, на которые ведется счетчик ссылок"""
+    STORED_FILE_FIELDS = ()
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        # Перечитанные имена файлов - уже сохраненные ссылки, их не нужно считать заново
+        names = self.stored_file_names()
+        if fields is not None:
+            names = {field: name for field, name in names.items() if field in fields}
+        self._stored_files.update(names)
+
+    def stored_file_names(self):
+        """Имена файлов в хранилище (без отложенных полей)"""
+        names = {}
+        for field in self.STORED_FILE_FIELDS:
+            if field in self.__dict__:
+                value = self.__dict__[field]
+                names[field] = getattr(value, 'name', value) or ''
+        return names
+
+
+class Book(StoredFilesMixin, models.Model):
     title = models.CharField(max_length=200)
     author = models.ForeignKey('Author', on_delete=models.CASCADE)
     genres = models.ManyToManyField('Genre')
     description = models.TextField(blank=True)
-    cover = models.ImageField(upload_to='covers/', blank=True, null=True)
-    book_file = models.FileField(upload_to='books/', blank=True, null=True) 
+    cover = models.ImageField(upload_to='covers/', storage=book_storage, blank=True, null=True)
+    book_file = models.FileField(upload_to='books/', storage=book_storage, blank=True, null=True) 
+    web_file = models.FileField(
+        upload_to='books/', storage=book_storage, blank=True, null=True,
+        editable=False, verbose_name="PDF для быстрого просмотра",
+    )
+    processed_file = models.CharField(max_length=255, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="Дата изменения")
     favorited_by = models.ManyToManyField(
         User, 
         related_name='favorite_books',
@@ -44,6 +81,8 @@ class Book(models.Model):
         verbose_name="В избранном у"
     )
     
+    STORED_FILE_FIELDS = ('book_file', 'cover', 'web_file')
+
     def __str__(self):
         return self.title
     
@@ -51,6 +90,118 @@ class Book(models.Model):
         verbose_name = "Книга"
         verbose_name_plural = "Книги"
 
+    @property
+    def version(self):
+        """Метка версии для ключей кэша карточки книги"""
+        return int(self.updated_at.timestamp() * 1000000)
+
+    @property
+    def is_pdf(self):
+        return bool(self.book_file) and self.book_file.name.lower().endswith('.pdf')
+
+    @property
+    def is_text(self):
+        from .textstore import is_compressed_text, is_plain_text
+        name = self.book_file.name if self.book_file else ''
+        return is_plain_text(name) or is_compressed_text(name)
+
+    @property
+    def file_format(self):
+        """Формат файла книги для читателя: PDF, TXT и т.п."""
+        if self.is_text:
+            return 'TXT'
+        return os.path.splitext(self.book_file.name)[1][1:].upper() if self.book_file else ''
+
+    @property
+    def is_processed(self):
+        """Быстрая копия и превью страниц сделаны из текущего файла книги"""
+        return bool(self.book_file) and self.processed_file == self.book_file.name
+
+    @property
+    def reader_file(self):
+        """Линеаризованный PDF, если он уже готов, иначе исходный файл"""
+        return self.web_file if self.web_file and self.is_processed else self.book_file
+
+
+class BookPage(StoredFilesMixin, models.Model):
+    """Картинка одной из первых страниц PDF для мгновенного просмотра"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='pages', verbose_name="Книга")
+    number = models.PositiveSmallIntegerField(verbose_name="Номер страницы")
+    image = models.ImageField(upload_to='pages/', storage=book_storage, verbose_name="Изображение")
+    width = models.PositiveIntegerField(default=0)
+    height = models.PositiveIntegerField(default=0)
+
+    STORED_FILE_FIELDS = ('image',)
+
+    class Meta:
+        verbose_name = "Страница книги"
+        verbose_name_plural = "Страницы книг"
+        unique_together = ('book', 'number')
+        ordering = ['number']
+
+class SimilarBook(models.Model):
+    """Заранее посчитанный сосед книги по сходству описания"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='similar_entries', verbose_name="Книга")
+    similar = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='+', verbose_name="Похожая книга")
+    score = models.FloatField(verbose_name="Сходство")
+    rank = models.PositiveSmallIntegerField(verbose_name="Место")
+
+    class Meta:
+        verbose_name = "Похожая книга"
+        verbose_name_plural = "Похожие книги"
+        unique_together = ('book', 'rank')
+        ordering = ['rank']
+
+class StoredFile(models.Model):
+    """Счетчик ссылок книг и страниц-превью на файл в хранилище по хэшу"""
+    name = models.CharField(max_length=255, unique=True, verbose_name="Путь к файлу")
+    ref_count = models.PositiveIntegerField(default=0, verbose_name="Количество ссылок")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = "Файл хранилища"
+        verbose_name_plural = "Файлы хранилища"
+
+    @classmethod
+    def acquire(cls, name):
+        if not is_hashed_name(name):
+            return
+        cls.objects.get_or_create(name=name)
+        cls.objects.filter(name=name).update(ref_count=F('ref_count') + 1)
+
+    @classmethod
+    def release(cls, name):
+        if not is_hashed_name(name):
+            return
+        cls.objects.filter(name=name, ref_count__gt=0).update(ref_count=F('ref_count') - 1)
+        transaction.on_commit(lambda: cls.delete_if_unused(name))
+
+    @classmethod
+    def delete_if_unused(cls, name):
+        """Удаляет файл, на который больше не ссылается ни одна книга"""
+        with transaction.atomic():
+            deleted, _ = cls.objects.filter(name=name, ref_count=0).delete()
+        if deleted:
+            with book_storage.lock():
+                # Пока строка удалялась, файл могла снова взять другая книга
+                if not cls.objects.filter(name=name).exists():
+                    book_storage.delete(name)
+
+    @classmethod
+    def ensure_exists(cls, name, content):
+        """Сохраняет файл заново, если его удалили между дедупликацией и acquire"""
+        with book_storage.lock():
+            if book_storage.exists(name):
+                return
+            if content is None or getattr(content, 'closed', False):
+                logger.error('Файл %s удален, пока на него ставилась ссылка, и содержимого нет', name)
+                return
+            content.seek(0)
+            book_storage.save(book_storage.source_name(name), content)
+
 class Favorite(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
     book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name="Книга")
@@ -61,6 +212,74 @@ class Favorite(models.Model):
         verbose_name_plural = "Избранные книги"
         unique_together = ('user', 'book')
 
+class FavoriteRemoval(models.Model):
+    """Журнал удалений из избранного для подсчета трендов"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name="Книга")
+    favorite_id = models.BigIntegerField(verbose_name="Удаленная запись избранного")
+    removed_at = models.DateTimeField(auto_now_add=True, verbose_name="Дата удаления")
+
+    class Meta:
+        verbose_name = "Удаление из избранного"
+        verbose_name_plural = "Удаления из избранного"
+
+class FavoriteRollup(models.Model):
+    """Число добавлений и удалений книги в избранное за день"""
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='rollups', verbose_name="Книга")
+    day = models.DateField(db_index=True, verbose_name="День")
+    adds = models.PositiveIntegerField(default=0, verbose_name="Добавлений")
+    removes = models.PositiveIntegerField(default=0, verbose_name="Удалений")
+
+    class Meta:
+        verbose_name = "Статистика избранного за день"
+        verbose_name_plural = "Статистика избранного по дням"
+        unique_together = ('book', 'day')
+
+class RollupWatermark(models.Model):
+    """Последняя обработанная запись журнала для инкрементального подсчета"""
+    name = models.CharField(max_length=50, unique=True)
+    last_id = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.name}: {self.last_id}'
+
+def get_trending_books(days=7, limit=5):
+    """Книги, чаще всего добавляемые в избранное за последние дни"""
+    since = timezone.now().date() - timedelta(days=days - 1)
+    return Book.objects.filter(rollups__day__gte=since).annotate(
+        trend_score=Sum('rollups__adds') - Sum('rollups__removes')
+    ).filter(trend_score__gt=0).select_related('author').order_by('-trend_score', '-id')[:limit]
+
+class ChunkedUpload(models.Model):
+    """Загрузка файла книги по частям с возможностью продолжения"""
+    STATUS_UPLOADING = 'uploading'
+    STATUS_COMPLETE = 'complete'
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, 'Загружается'),
+        (STATUS_COMPLETE, 'Завершена'),
+    ]
+
+    upload_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, verbose_name="Пользователь")
+    book = models.ForeignKey(Book, on_delete=models.CASCADE, verbose_name="Книга")
+    filename = models.CharField(max_length=255, verbose_name="Имя файла")
+    total_size = models.BigIntegerField(verbose_name="Размер файла")
+    offset = models.BigIntegerField(default=0, verbose_name="Загружено байт")
+    checksum = models.CharField(max_length=64, blank=True, verbose_name="SHA-256")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_UPLOADING, verbose_name="Статус")
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.filename} ({self.offset}/{self.total_size})'
+
+    class Meta:
+        verbose_name = "Загрузка файла"
+        verbose_name_plural = "Загрузки файлов"
+
+    @property
+    def temp_path(self):
+        return os.path.join(settings.CHUNKED_UPLOAD_DIR, f'{self.upload_id}.part')
+
 class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='profile')
     
@@ -116,17 +335,15 @@ class Profile(models.Model):
     
     def get_recommended_books(self, limit=4):
         """Получить рекомендации на основе избранных книг пользователя"""
-        favorite_books = self.user.favorite_books.all()
+        favorite_books = list(self.user.favorite_books.all())
         
-        if not favorite_books.exists():
+        if not favorite_books:
             return Book.objects.annotate(
                 favorite_count=Count('favorited_by')
             ).order_by('-favorite_count')[:limit]
         
-        favorite_genres = set()
-        for book in favorite_books:
-            favorite_genres.update(book.genres.all())
-        favorite_authors = set(book.author for book in favorite_books)
+        favorite_genres = Genre.objects.filter(book__favorited_by=self.user)
+        favorite_authors = {book.author_id for book in favorite_books}
         
         recommended = Book.objects.filter(
             Q(genres__in=favorite_genres) | Q(author__in=favorite_authors)
@@ -149,4 +366,163 @@ def save_user_profile(sender, instance, **kwargs):
     try:
         instance.profile.save()
     except Profile.DoesNotExist:
-        Profile.objects.create(user=instance)
\ No newline at end of file
+        Profile.objects.create(user=instance)
+
+@receiver(pre_save, sender=Book)
+def compress_text_book(sender, instance, update_fields=None, **kwargs):
+    """Новый текстовый файл книги сохраняется в сжатом виде"""
+    from .textstore import compressed_copy, is_plain_text
+    if update_fields is not None and 'book_file' not in update_fields:
+        return
+    book_file = instance.book_file
+    # Уже сохраненные .txt, загруженные до сжатия, переводит команда compress_texts
+    if not is_plain_text(book_file.name) or book_file._committed:
+        return
+    instance.book_file = compressed_copy(book_file)
+
+@receiver(pre_save, sender=Book)
+@receiver(pre_save, sender=BookPage)
+def remember_new_file_contents(sender, instance, **kwargs):
+    # После сохранения в поле остается только имя, а содержимое нужно ensure_exists
+    instance._new_contents = {
+        field: instance.__dict__[field].file
+        for field in instance.STORED_FILE_FIELDS
+        if isinstance(instance.__dict__.get(field), FieldFile) and not instance.__dict__[field]._committed
+    }
+
+@receiver(post_init, sender=Book)
+@receiver(post_init, sender=BookPage)
+def remember_book_files(sender, instance, **kwargs):
+    instance._stored_files = instance.stored_file_names()
+
+@receiver(post_save, sender=Book)
+def reset_pdf_processing(sender, instance, created, **kwargs):
+    """Быстрая копия и превью прежнего файла не должны показываться для нового"""
+    if created or 'book_file' not in instance.__dict__ \
+            or instance.book_file.name == instance._stored_files.get('book_file'):
+        return
+    if 'web_file' not in instance._stored_files:
+        instance._stored_files['web_file'] = Book.objects.filter(pk=instance.pk).values_list(
+            'web_file', flat=True).first() or ''
+    if not instance._stored_files['web_file'] and not instance.processed_file:
+        return
+    # Счетчик ссылок на старую копию уменьшит count_book_file_references
+    instance.web_file = None
+    instance.processed_file = ''
+    Book.objects.filter(pk=instance.pk).update(web_file='', processed_file='')
+    BookPage.objects.filter(book=instance).delete()
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=BookPage)
+def count_book_file_references(sender, instance, **kwargs):
+    current = instance.stored_file_names()
+    with transaction.atomic():
+        for field, name in current.items():
+            previous = instance._stored_files.get(field, '')
+            if name != previous:
+                StoredFile.acquire(name)
+                StoredFile.release(previous)
+                if is_hashed_name(name):
+                    content = getattr(instance, '_new_contents', {}).get(field)
+                    transaction.on_commit(
+                        lambda name=name, content=content: StoredFile.ensure_exists(name, content)
+                    )
+    instance._stored_files = current
+
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=BookPage)
+def release_book_files(sender, instance, **kwargs):
+    for name in instance._stored_files.values():
+        StoredFile.release(name)
+
+SIMILARITY_FIELDS = {'title', 'description', 'author', 'author_id'}
+
+def schedule_similarity_update(book_ids):
+    """Копит id книг до конца транзакции и пересчитывает соседей один раз"""
+    book_ids = set(book_ids)
+    if not book_ids:
+        return
+    connection = transaction.get_connection()
+    pending = getattr(connection, 'similarity_update', None)
+    # После отката транзакции колбэк пропадает из run_on_commit, тогда заводим новый
+    if pending is not None and any(func is pending for _, func in connection.run_on_commit):
+        pending.book_ids.update(book_ids)
+        return
+
+    def pending():
+        from .similarity import update_similar_books
+        if connection.similarity_update is pending:
+            connection.similarity_update = None
+        update_similar_books(sorted(pending.book_ids))
+    pending.book_ids = book_ids
+    connection.similarity_update = pending
+    transaction.on_commit(pending)
+
+@receiver(post_save, sender=Book)
+def update_book_similarity(sender, instance, update_fields=None, **kwargs):
+    if update_fields is None or SIMILARITY_FIELDS.intersection(update_fields):
+        schedule_similarity_update([instance.pk])
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def update_similarity_on_genres(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            schedule_similarity_update([instance.pk])
+        elif pk_set:
+            schedule_similarity_update(pk_set)
+
+@receiver(post_save, sender=Author)
+def update_similarity_on_author(sender, instance, created, **kwargs):
+    if not created:
+        schedule_similarity_update(instance.book_set.values_list('pk', flat=True))
+
+@receiver(pre_delete, sender=Book)
+def update_similarity_on_delete(sender, instance, **kwargs):
+    schedule_similarity_update(
+        SimilarBook.objects.filter(similar=instance).values_list('book_id', flat=True)
+    )
+
+def touch_books(books):
+    """Обновляет версию книг, чьи автор или жанры изменились"""
+    books.update(updated_at=timezone.now())
+
+@receiver(post_save, sender=Author)
+def touch_author_books(sender, instance, created, **kwargs):
+    if not created:
+        touch_books(Book.objects.filter(author=instance))
+
+@receiver(post_save, sender=Genre)
+def touch_genre_books(sender, instance, created, **kwargs):
+    if not created:
+        touch_books(Book.objects.filter(genres=instance))
+
+@receiver(pre_delete, sender=Genre)
+def touch_books_before_genre_delete(sender, instance, **kwargs):
+    touch_books(Book.objects.filter(genres=instance))
+
+@receiver(m2m_changed, sender=Book.genres.through)
+def touch_books_on_genres(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse and action in ('post_add', 'post_remove', 'post_clear'):
+        touch_books(Book.objects.filter(pk=instance.pk))
+    elif reverse and action in ('post_add', 'post_remove') and pk_set:
+        touch_books(Book.objects.filter(pk__in=pk_set))
+    elif reverse and action == 'pre_clear':
+        touch_books(Book.objects.filter(genres=instance))
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_delete, sender=Author)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+@receiver(m2m_changed, sender=Book.genres.through)
+def invalidate_catalog_pages(sender, **kwargs):
+    from .caching import bump_catalog_version
+    transaction.on_commit(bump_catalog_version)
+
+@receiver(post_save, sender=Book)
+def schedule_pdf_processing(sender, instance, **kwargs):
+    if instance.is_pdf and instance.processed_file != instance.book_file.name \
+            and settings.PDF_PROCESS_IN_BACKGROUND:
+        from .pdf import process_in_background
+        transaction.on_commit(lambda: process_in_background(instance.pk))
@@ -0,0 +1,79 @@
+"""Подготовка PDF к быстрому чтению онлайн.
+
+Для каждого загруженного PDF в фоне создается линеаризованная копия ("fast
+web view"), которую браузер может показывать по мере загрузки, и картинки
+первых страниц, чтобы читатель сразу видел начало книги.
+"""
+import io
+import logging
+import os
+import tempfile
+import threading
+
+import pikepdf
+import pypdfium2
+from django.conf import settings
+from django.core.files import File
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+
+from .models import Book, BookPage
+
+logger = logging.getLogger(__name__)
+
+
+def linearize(source, target):
+    with pikepdf.open(source) as pdf:
+        pdf.save(target, linearize=True)
+
+
+def render_pages(source, count, scale):
+    """JPEG первых страниц PDF с их размерами"""
+    document = pypdfium2.PdfDocument(source)
+    try:
+        for number in range(min(count, len(document))):
+            image = document[number].render(scale=scale).to_pil().convert('RGB')
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=80, optimize=True, progressive=True)
+            yield number + 1, buffer.getvalue(), image.size
+    finally:
+        document.close()
+
+
+def process_book_pdf(book_id):
+    """Создает линеаризованную копию и превью страниц для PDF книги"""
+    book = Book.objects.get(pk=book_id)
+    if not book.is_pdf or book.processed_file == book.book_file.name:
+        return False
+
+    source_name = book.book_file.name
+    with tempfile.TemporaryDirectory() as directory:
+        target = os.path.join(directory, 'web.pdf')
+        linearize(book.book_file.path, target)
+        pages = list(render_pages(book.book_file.path, settings.PDF_PREVIEW_PAGES, settings.PDF_PREVIEW_SCALE))
+        with open(target, 'rb') as web_file, transaction.atomic():
+            book = Book.objects.select_for_update().get(pk=book_id)
+            if book.book_file.name != source_name:
+                # Пока шла обработка, файл книги заменили
+                return False
+            book.pages.all().delete()
+            # Картинки сохраняются через поле, чтобы на них велся счетчик ссылок
+            for number, content, (width, height) in pages:
+                BookPage.objects.create(book=book, number=number, width=width, height=height,
+                                        image=ContentFile(content, name=f'{number}.jpg'))
+            book.web_file = File(web_file, 'web.pdf')
+            book.processed_file = source_name
+            book.save(update_fields=['web_file', 'processed_file'])
+    return True
+
+
+def process_in_background(book_id):
+    def run():
+        try:
+            process_book_pdf(book_id)
+        except Exception:
+            logger.exception('Не удалось подготовить PDF книги %s', book_id)
+        finally:
+            connection.close()
+
+    threading.Thread(target=run, daemon=True).start()
@@ -0,0 +1,144 @@
+"""Ограничение частоты запросов к отдельным URL по IP и пользователю.
+
+Правила задаются в settings.RATELIMITS по имени URL. Для каждого окна в
+кэше settings.RATELIMIT_CACHE хранится счетчик выданных токенов, который
+увеличивается атомарным cache.incr. Число запросов за последний период
+оценивается скользящим окном: счетчик текущего окна плюс счетчик прошлого
+с весом той части периода, что еще в него попадает. Поэтому на границе окон
+не проходит двойной лимит, как у фиксированного окна. Процесс забирает
+токены пачкой и тратит их локально, а счетчик прошлого окна читает один раз
+за окно, поэтому большинство разрешенных запросов обходятся без обращения
+к кэшу. Лимит общий для всех процессов, только если кэш общий и
+incr в нем атомарный (Memcached, Redis); с кэшем в памяти процесса
+middleware отказывается работать, если это явно не разрешено
+RATELIMIT_ALLOW_LOCAL_CACHE для одного процесса.
+"""
+import math
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.db import DatabaseCache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.filebased import FileBasedCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+# Эти кэши либо свои у каждого процесса, либо увеличивают счетчик не атомарно
+LOCAL_CACHES = (LocMemCache, DummyCache, FileBasedCache, DatabaseCache)
+
+Rule = namedtuple('Rule', 'limit period methods lease')
+
+
+def parse_rule(config):
+    if isinstance(config, str):
+        config = {'rate': config}
+    count, _, unit = config['rate'].partition('/')
+    limit = int(count)
+    methods = config.get('methods')
+    return Rule(
+        limit=limit,
+        period=PERIODS[unit[:1]],
+        methods={method.upper() for method in methods} if methods else None,
+        lease=config.get('lease', max(1, limit // 10)),
+    )
+
+
+class RateLimitMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.rules = {name: parse_rule(config) for name, config in getattr(settings, 'RATELIMITS', {}).items()}
+        self.cache_alias = getattr(settings, 'RATELIMIT_CACHE', 'default')
+        backend = caches[self.cache_alias]
+        if self.rules and isinstance(backend, LOCAL_CACHES) \
+                and not getattr(settings, 'RATELIMIT_ALLOW_LOCAL_CACHE', False):
+            raise ImproperlyConfigured(
+                f'Кэш {self.cache_alias!r} ({type(backend).__name__}) не общий для процессов '
+                'или не атомарный: лимиты умножились бы на число воркеров. Укажите Memcached '
+                'или Redis (MEMCACHED_LOCATION) либо RATELIMIT_ALLOW_LOCAL_CACHE = True для одного процесса.'
+            )
+        self.leases = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        rule = self.rules.get(match.url_name if match else None)
+        if rule is None or (rule.methods and request.method not in rule.methods):
+            return None
+
+        for identity in self.identities(request):
+            retry_after = self.consume(match.url_name, identity, rule)
+            if retry_after:
+                response = HttpResponse(
+                    'Слишком много запросов. Попробуйте позже.',
+                    status=429, content_type='text/plain; charset=utf-8',
+                )
+                response['Retry-After'] = str(retry_after)
+                return response
+        return None
+
+    def identities(self, request):
+        yield 'ip:' + request.META.get('REMOTE_ADDR', '')
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            yield f'user:{user.pk}'
+
+    def consume(self, name, identity, rule):
+        """Берет токен; возвращает 0 или число секунд, через которое он появится"""
+        now = time.time()
+        window = int(now // rule.period)
+        bucket = (name, identity)
+
+        with self.lock:
+            lease_window, remaining, previous = self.leases.get(bucket, (None, 0, None))
+            if lease_window == window and remaining > 0:
+                self.leases[bucket] = (window, remaining - 1, previous)
+                return 0
+
+        prefix = f'ratelimit:{name}:{identity}'
+        key = f'{prefix}:{window}'
+        cache = caches[self.cache_alias]
+        if lease_window != window:
+            # Прошлое окно уже закрыто, его счетчик читается один раз за окно
+            previous = cache.get(f'{prefix}:{window - 1}', 0)
+        try:
+            issued = cache.incr(key, rule.lease)
+        except ValueError:
+            # Ключ живет два периода: в следующем окне он становится прошлым
+            cache.add(key, 0, 2 * rule.period + 1)
+            issued = cache.incr(key, rule.lease)
+
+        weight = 1 - (now % rule.period) / rule.period
+        allowed = rule.limit - math.ceil(previous * weight)
+        granted = min(rule.lease, allowed - (issued - rule.lease))
+        if granted < rule.lease:
+            # Невыданные токены возвращаются, чтобы отказы не раздували счетчик
+            cache.decr(key, rule.lease - max(granted, 0))
+        if granted <= 0:
+            return self.retry_after(rule, now, previous, issued - rule.lease)
+
+        with self.lock:
+            if len(self.leases) > 10000:
+                self.leases = {
+                    key: value for key, value in self.leases.items() if value[0] == window
+                }
+            self.leases[bucket] = (window, granted - 1, previous)
+        return 0
+
+    def retry_after(self, rule, now, previous, current):
+        """Секунды, через которые оценка числа запросов опустится ниже лимита"""
+        elapsed = now % rule.period
+        if current < rule.limit:
+            # В этом окне: ждем, пока вес прошлого окна уменьшится
+            wait = rule.period * (1 - (rule.limit - current) / previous) - elapsed
+        else:
+            # В следующем окне текущее станет прошлым и должно "остыть"
+            wait = rule.period - elapsed + rule.period * (1 - rule.limit / current)
+        return max(1, math.ceil(wait))
@@ -0,0 +1,46 @@
+"""Инкрементальный подсчет добавлений и удалений из избранного по дням.
+
+Каждый запуск обрабатывает только записи Favorite и FavoriteRemoval с id
+больше сохраненной отметки, поэтому история избранного целиком не читается.
+"""
+from django.db import transaction
+from django.db.models import Count, F, Max, Q
+from django.db.models.functions import TruncDate
+
+from .models import Favorite, FavoriteRemoval, FavoriteRollup, RollupWatermark
+
+
+def _advance(model, counter, extra_filter=None):
+    watermark, _ = RollupWatermark.objects.select_for_update().get_or_create(
+        name=model._meta.model_name
+    )
+    previous = watermark.last_id
+    upper = model.objects.aggregate(last=Max('id'))['last'] or previous
+    rows = model.objects.filter(id__gt=previous, id__lte=upper)
+    if extra_filter is not None:
+        rows = rows.filter(extra_filter)
+
+    time_field = 'added_at' if model is Favorite else 'removed_at'
+    buckets = rows.annotate(day=TruncDate(time_field)).values('book_id', 'day').annotate(total=Count('id'))
+
+    processed = 0
+    for bucket in buckets:
+        rollup, _ = FavoriteRollup.objects.get_or_create(book_id=bucket['book_id'], day=bucket['day'])
+        FavoriteRollup.objects.filter(pk=rollup.pk).update(**{counter: F(counter) + bucket['total']})
+        processed += bucket['total']
+
+    watermark.last_id = max(upper, previous)
+    watermark.save(update_fields=['last_id'])
+    return processed, previous
+
+
+def rollup_favorites():
+    """Переносит новые события избранного в дневные счетчики"""
+    with transaction.atomic():
+        adds, counted_favorite_id = _advance(Favorite, 'adds')
+        # Удаление записи, добавление которой не успело попасть в счетчики
+        # до прошлого запуска, не учитываем: иначе книга получила бы минус без плюса.
+        removes, _ = _advance(
+            FavoriteRemoval, 'removes', Q(favorite_id__lte=counted_favorite_id)
+        )
+    return adds, removes
@@ -0,0 +1,186 @@
+"""Похожие книги по TF-IDF векторам описания, названия и жанров.
+
+Векторы и соседи считаются пакетно на NumPy/SciPy и сохраняются в таблицу
+SimilarBook, так что страница книги читает готовый список одним запросом.
+Счетчики терминов книг процесс держит в памяти и токенизирует заново только
+книги, у которых сменился updated_at (он меняется и при правке автора или
+жанров), поэтому сохранение книги не перечитывает весь каталог.
+"""
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+from scipy import sparse
+
+from django.db import transaction
+
+from .models import Book, SimilarBook
+
+SIMILAR_BOOKS_COUNT = 6
+TITLE_WEIGHT = 3
+GENRE_WEIGHT = 2
+BLOCK_SIZE = 512
+
+TOKEN_RE = re.compile(r'\w{3,}')
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower().replace('ё', 'е'))
+
+
+def book_tokens(book):
+    """Токены книги: название и жанры весят больше, чем описание"""
+    tokens = tokenize(book.description or '')
+    tokens += tokenize(book.title) * TITLE_WEIGHT
+    tokens += tokenize(book.author.name)
+    for genre in book.genres.all():
+        tokens.append('жанр:' + genre.name.lower())
+        tokens += tokenize(genre.name) * (GENRE_WEIGHT - 1)
+    return tokens
+
+
+class TermCounts:
+    """Счетчики терминов книг с их updated_at и общий словарь процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.vocabulary = {}
+        self.books = {}
+
+    def vectorize(self, book):
+        counts = Counter(book_tokens(book))
+        terms = np.fromiter(
+            (self.vocabulary.setdefault(term, len(self.vocabulary)) for term in counts),
+            dtype=np.int32, count=len(counts),
+        )
+        return book.updated_at, terms, np.fromiter(counts.values(), dtype=np.float32, count=len(counts))
+
+    def refresh(self):
+        """Токенизирует заново только новые и изменившиеся книги; возвращает id по порядку"""
+        versions = list(Book.objects.order_by('id').values_list('id', 'updated_at'))
+        stale = [book_id for book_id, updated_at in versions if self.books.get(book_id, (None,))[0] != updated_at]
+        for start in range(0, len(stale), BLOCK_SIZE):
+            books = Book.objects.filter(pk__in=stale[start:start + BLOCK_SIZE]) \
+                .select_related('author').prefetch_related('genres')
+            for book in books:
+                self.books[book.id] = self.vectorize(book)
+        ids = [book_id for book_id, _ in versions if book_id in self.books]
+        self.books = {book_id: self.books[book_id] for book_id in ids}
+        return ids
+
+    def matrix(self):
+        """id книг и матрица счетчиков (книги x термины)"""
+        with self.lock:
+            ids = self.refresh()
+            rows = [self.books[book_id] for book_id in ids]
+            indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum([len(terms) for _, terms, _ in rows], out=indptr[1:])
+            matrix = sparse.csr_matrix((
+                np.concatenate([counts for _, _, counts in rows] or [np.zeros(0, np.float32)]),
+                np.concatenate([terms for _, terms, _ in rows] or [np.zeros(0, np.int32)]),
+                indptr,
+            ), shape=(len(ids), len(self.vocabulary)))
+            # Термины старых версий книг остаются в словаре; когда их становится
+            # слишком много, следующий вызов строит словарь заново
+            if len(self.vocabulary) > 2 * len(np.unique(matrix.indices)) + 10000:
+                self.clear()
+        return ids, matrix
+
+
+_term_counts = TermCounts()
+
+
+def build_matrix():
+    """Возвращает id книг и нормированную TF-IDF матрицу (книги x термины)"""
+    ids, matrix = _term_counts.matrix()
+    if not ids:
+        return np.asarray(ids, dtype=np.int64), matrix
+
+    document_frequency = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idf = np.log((1 + len(ids)) / (1 + document_frequency)).astype(np.float32) + 1
+    matrix.data = (1 + np.log(matrix.data)) * idf[matrix.indices]
+
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    matrix = sparse.diags(1 / norms) @ matrix
+    return np.asarray(ids, dtype=np.int64), matrix.tocsr()
+
+
+def top_neighbors(scores, ids, own_index, k):
+    """Лучшие k соседей для строки косинусных сходств"""
+    scores = np.asarray(scores).ravel()
+    scores[own_index] = 0
+    if len(scores) > k:
+        candidates = np.argpartition(-scores, k)[:k]
+    else:
+        candidates = np.arange(len(scores))
+    candidates = candidates[scores[candidates] > 0]
+    order = candidates[np.argsort(-scores[candidates], kind='stable')]
+    return [(int(ids[index]), float(scores[index])) for index in order]
+
+
+def neighbor_entries(book_id, neighbors):
+    return [
+        SimilarBook(book_id=book_id, similar_id=similar_id, score=score, rank=rank)
+        for rank, (similar_id, score) in enumerate(neighbors, start=1)
+    ]
+
+
+def rebuild_similar_books(k=SIMILAR_BOOKS_COUNT):
+    """Пересчитывает таблицу похожих книг для всего каталога"""
+    ids, matrix = build_matrix()
+    transposed = matrix.T.tocsc()
+    entries = []
+
+    for start in range(0, len(ids), BLOCK_SIZE):
+        block = (matrix[start:start + BLOCK_SIZE] @ transposed).toarray()
+        for offset, scores in enumerate(block):
+            index = start + offset
+            entries += neighbor_entries(ids[index], top_neighbors(scores, ids, index, k))
+
+    with transaction.atomic():
+        SimilarBook.objects.all().delete()
+        SimilarBook.objects.bulk_create(entries, batch_size=500)
+    return len(entries)
+
+
+def update_similar_books(book_ids, k=SIMILAR_BOOKS_COUNT):
+    """Инкрементально обновляет соседей после изменения книг
+
+    Пересчитываются строки самих книг и тех книг, в чьих списках они уже
+    есть или куда могут попасть с новым сходством.
+    """
+    ids, matrix = build_matrix()
+    positions = {int(book_id): index for index, book_id in enumerate(ids)}
+    changed = [positions[book_id] for book_id in book_ids if book_id in positions]
+
+    affected = set(changed)
+    affected.update(
+        positions[book_id]
+        for book_id in SimilarBook.objects.filter(similar_id__in=book_ids).values_list('book_id', flat=True)
+        if book_id in positions
+    )
+    if changed:
+        weakest = dict(
+            SimilarBook.objects.filter(rank=k).values_list('book_id', 'score')
+        )
+        scores = (matrix[changed] @ matrix.T).toarray().max(axis=0)
+        for index in np.flatnonzero(scores > 0):
+            if scores[index] > weakest.get(int(ids[index]), 0):
+                affected.add(int(index))
+
+    affected = sorted(affected)
+    entries = []
+    if affected:
+        block = (matrix[affected] @ matrix.T).toarray()
+        for scores, index in zip(block, affected):
+            entries += neighbor_entries(ids[index], top_neighbors(scores, ids, index, k))
+
+    with transaction.atomic():
+        SimilarBook.objects.filter(book_id__in=[int(ids[index]) for index in affected]).delete()
+        SimilarBook.objects.bulk_create(entries)
+    return len(affected)
@@ -0,0 +1,198 @@
+"""Снимок каталога в файле, общий для всех процессов через mmap.
+
+В снимке лежат жанры с числом книг, авторы и книги с их автором и жанрами.
+Числа хранятся плоскими массивами, строки - одним блоком UTF-8, поэтому
+процессы читают файл через memoryview без копирования и без запросов к
+базе. Файл пересобирается во временный и атомарно подменяется. Процесс
+сравнивает версию своего снимка с версией каталога из library.caching,
+общей для всех процессов, и при отставании открывает файл заново, а
+пересобирает его, только если и в файле версия старая.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from array import array
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Count
+
+from .caching import get_catalog_version
+
+MAGIC = b'LIBSNAP1'
+HEADER = struct.Struct('<8sq4q')
+SECTIONS = (
+    ('genre_ids', 'q'), ('genre_counts', 'q'), ('genre_names', 'I'),
+    ('author_ids', 'q'), ('author_names', 'I'),
+    ('book_ids', 'q'), ('book_authors', 'i'), ('book_titles', 'I'),
+    ('book_genre_offsets', 'I'), ('book_genres', 'i'),
+)
+SECTION_TABLE = struct.Struct('<' + 'qq' * len(SECTIONS))
+
+GenreEntry = namedtuple('GenreEntry', 'id name book_count')
+AuthorEntry = namedtuple('AuthorEntry', 'id name')
+
+
+def _collect():
+    from .models import Author, Book, Genre
+
+    genres = list(Genre.objects.annotate(book_count=Count('book')).values_list('id', 'name', 'book_count'))
+    authors = list(Author.objects.values_list('id', 'name'))
+    books = list(Book.objects.order_by('-id').values_list('id', 'title', 'author_id'))
+    book_genres = {}
+    for book_id, genre_id in Book.genres.through.objects.values_list('book_id', 'genre_id'):
+        book_genres.setdefault(book_id, []).append(genre_id)
+    return genres, authors, books, book_genres
+
+
+def build_snapshot(path, version):
+    """Собирает снимок во временный файл и атомарно подменяет им старый"""
+    genres, authors, books, book_genres = _collect()
+    strings = bytearray()
+    genre_index = {genre_id: index for index, (genre_id, _, _) in enumerate(genres)}
+    author_index = {author_id: index for index, (author_id, _) in enumerate(authors)}
+
+    arrays = {name: array(code) for name, code in SECTIONS}
+    # Таблица смещений строк на одну запись длиннее: строка i - [offsets[i], offsets[i + 1])
+    arrays['genre_names'].append(len(strings))
+    for genre_id, name, book_count in genres:
+        arrays['genre_ids'].append(genre_id)
+        arrays['genre_counts'].append(book_count)
+        strings += name.encode('utf-8')
+        arrays['genre_names'].append(len(strings))
+
+    arrays['author_names'].append(len(strings))
+    for author_id, name in authors:
+        arrays['author_ids'].append(author_id)
+        strings += name.encode('utf-8')
+        arrays['author_names'].append(len(strings))
+
+    arrays['book_titles'].append(len(strings))
+    arrays['book_genre_offsets'].append(0)
+    for book_id, title, author_id in books:
+        arrays['book_ids'].append(book_id)
+        arrays['book_authors'].append(author_index.get(author_id, -1))
+        strings += title.encode('utf-8')
+        arrays['book_titles'].append(len(strings))
+        arrays['book_genres'].extend(
+            genre_index[genre_id] for genre_id in book_genres.get(book_id, ()) if genre_id in genre_index
+        )
+        arrays['book_genre_offsets'].append(len(arrays['book_genres']))
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.snapshot-')
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            position = HEADER.size + SECTION_TABLE.size
+            table = []
+            payloads = []
+            for name, _ in SECTIONS:
+                data = arrays[name].tobytes()
+                position += -position % 8
+                table += [position, len(data)]
+                payloads.append((position, data))
+                position += len(data)
+            position += -position % 8
+            strings_offset = position
+
+            output.write(HEADER.pack(MAGIC, version, len(genres), len(authors), len(books), strings_offset))
+            output.write(SECTION_TABLE.pack(*table))
+            for offset, data in payloads:
+                output.write(b'\0' * (offset - output.tell()))
+                output.write(data)
+            output.write(b'\0' * (strings_offset - output.tell()))
+            output.write(strings)
+            output.flush()
+            os.fsync(output.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class CatalogSnapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as snapshot_file:
+            self._mmap = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self._mmap)
+        magic, self.version, self.genre_count, self.author_count, self.book_count, strings_offset = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC:
+            raise ValueError(f'{path} не является снимком каталога')
+
+        table = SECTION_TABLE.unpack_from(view, HEADER.size)
+        for number, (name, code) in enumerate(SECTIONS):
+            offset, size = table[2 * number], table[2 * number + 1]
+            setattr(self, name, view[offset:offset + size].cast(code))
+        self.strings = view[strings_offset:]
+
+    def _string(self, offsets, index):
+        return bytes(self.strings[offsets[index]:offsets[index + 1]]).decode('utf-8')
+
+    def genre(self, index):
+        return GenreEntry(self.genre_ids[index], self._string(self.genre_names, index), self.genre_counts[index])
+
+    def genres(self):
+        return [self.genre(index) for index in range(self.genre_count)]
+
+    def authors(self):
+        return [
+            AuthorEntry(self.author_ids[index], self._string(self.author_names, index))
+            for index in range(self.author_count)
+        ]
+
+    @property
+    def total_books(self):
+        return self.book_count
+
+    def genres_for_book(self, book_id):
+        """Жанры книги по id; книги в снимке отсортированы по убыванию id"""
+        low, high = 0, self.book_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.book_ids[middle] > book_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low == self.book_count or self.book_ids[low] != book_id:
+            return []
+        start, end = self.book_genre_offsets[low], self.book_genre_offsets[low + 1]
+        return [self.genre(index) for index in self.book_genres[start:end]]
+
+
+_lock = threading.Lock()
+_snapshot = None
+
+
+def _open(path):
+    try:
+        return CatalogSnapshot(path)
+    except (FileNotFoundError, ValueError, struct.error):
+        return None
+
+
+def get_snapshot():
+    """Текущий снимок каталога; пересобирает его, если каталог изменился"""
+    global _snapshot
+    version = get_catalog_version()
+    snapshot = _snapshot
+    if snapshot is not None and snapshot.version >= version:
+        return snapshot
+
+    with _lock:
+        path = settings.CATALOG_SNAPSHOT_PATH
+        snapshot = _open(path)
+        if snapshot is None or snapshot.version < version:
+            build_snapshot(path, version)
+            snapshot = _open(path)
+        _snapshot = snapshot
+    return snapshot
+
+
+def current_snapshot():
+    """Снимок, уже проверенный в этом процессе, без повторной проверки версии"""
+    return _snapshot or get_snapshot()
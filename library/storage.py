@@ -0,0 +1,118 @@
+import hashlib
+import os
+import posixpath
+import re
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировка только внутри процесса
+    fcntl = None
+
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+TEMP_PREFIX = '.upload-'
+LOCK_NAME = '.storage.lock'
+SAFE_EXTENSION = re.compile(r'^\.[a-z0-9]{1,10}$')
+HASHED_NAME = re.compile(r'^(?:[^/]+/)*[0-9a-f]{2}/[0-9a-f]{64}(?:\.[a-z0-9]{1,10})?$')
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранилище, в котором файл называется по SHA-256 своего содержимого.
+
+    Загрузка хэшируется за один проход одновременно с записью во временный
+    файл, после чего он атомарно переносится на место. Одинаковые файлы
+    хранятся один раз: повторная загрузка возвращает уже существующее имя.
+    """
+
+    hash_algorithm = 'sha256'
+    _thread_lock = threading.Lock()
+
+    def hashed_name(self, dirname, digest, original_name):
+        """Путь вида books/ab/<hash>.pdf для данного хэша"""
+        ext = os.path.splitext(original_name)[1].lower()
+        if not SAFE_EXTENSION.match(ext):
+            ext = ''
+        return posixpath.join(dirname, digest[:2], digest + ext)
+
+    def _save(self, name, content):
+        dirname, basename = posixpath.split(name.replace('\\', '/'))
+        directory = self.path(dirname)
+        os.makedirs(directory, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=TEMP_PREFIX)
+        hasher = hashlib.new(self.hash_algorithm)
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    temp_file.write(chunk)
+
+            final_name = self.hashed_name(dirname, hasher.hexdigest(), basename)
+            final_path = self.path(final_name)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+
+            if os.path.exists(final_path):
+                os.remove(temp_path)
+            else:
+                if self.file_permissions_mode is not None:
+                    os.chmod(temp_path, self.file_permissions_mode)
+                os.replace(temp_path, final_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return final_name
+
+    def source_name(self, name):
+        """Имя, под которым содержимое нужно сохранить заново, чтобы получить name"""
+        dirname, basename = posixpath.split(name)
+        return posixpath.join(posixpath.dirname(dirname), basename)
+
+    @contextmanager
+    def lock(self):
+        """Блокировка, общая для всех процессов: удаление файла и проверка его наличия"""
+        with self._thread_lock:
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.location, exist_ok=True)
+            with open(os.path.join(self.location, LOCK_NAME), 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_available_name(self, name, max_length=None):
+        # Итоговое имя определяется содержимым в _save, поэтому
+        # подбирать свободное имя заранее не нужно.
+        return name
+
+
+book_storage = ContentAddressedStorage()
+
+
+def is_hashed_name(name):
+    """Проверяет, что файл был сохранен в хранилище по хэшу"""
+    return bool(name) and bool(HASHED_NAME.match(name))
+
+
+def iter_media_files(root, skip_prefixes=(TEMP_PREFIX,)):
+    """Потоково обходит каталог и возвращает относительные пути файлов"""
+    stack = ['']
+    while stack:
+        relative_dir = stack.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative_path = posixpath.join(relative_dir, entry.name) if relative_dir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative_path)
+                elif entry.is_file(follow_symlinks=False):
+                    if not entry.name.startswith(skip_prefixes):
+                        yield relative_path, entry
@@ -0,0 +1,15 @@
+from django import template
+
+from library.snapshot import current_snapshot
+
+register = template.Library()
+
+
+@register.filter
+def catalog_genres(book, snapshot=None):
+    """Жанры книги из снимка каталога, без запроса к базе
+
+    Снимок передается тот же, чья версия входит в ключ кэша карточки: книга
+    могла измениться уже после того, как view взял снимок.
+    """
+    return (snapshot or current_snapshot()).genres_for_book(book.pk)
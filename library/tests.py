@@ -0,0 +1,791 @@
+"""Бюджет запросов к базе для страниц библиотеки.
+
+Каждая страница запрашивается на каталоге двух размеров с холодными кэшами.
+Число запросов не должно зависеть от объема данных; если оно растет, тест
+показывает отпечатки SQL, которых стало больше, - обычно это запрос на
+каждую строку списка, спрятанный в шаблоне или в цикле во view.
+"""
+import hashlib
+import io
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import autocomplete, similarity, snapshot, textstore
+from .caching import get_catalog_version
+from .ratelimit import RateLimitMiddleware, parse_rule
+from .pdf import process_book_pdf
+from .models import (
+    Author, Book, BookPage, ChunkedUpload, Favorite, FavoriteRemoval, FavoriteRollup, Genre, SimilarBook, StoredFile,
+)
+from .storage import book_storage
+
+SIZES = (4, 16)
+
+STRING_RE = re.compile(r"'(?:[^']|'')*'")
+NUMBER_RE = re.compile(r'\b\d+(?:\.\d+)?\b')
+LIST_RE = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+SAVEPOINT_RE = re.compile(r'"s\d+_x\d+"')
+SPACES_RE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """SQL без литералов: одинаковые запросы с разными параметрами совпадают"""
+    sql = SAVEPOINT_RE.sub('?', sql)
+    sql = STRING_RE.sub('?', sql)
+    sql = NUMBER_RE.sub('?', sql)
+    sql = LIST_RE.sub('(...)', sql)
+    return SPACES_RE.sub(' ', sql).strip()
+
+
+def reset_caches():
+    """Сбрасывает кэш и индексы процесса, чтобы каждая страница строилась заново"""
+    cache.clear()
+    if os.path.exists(settings.CATALOG_VERSION_PATH):
+        os.remove(settings.CATALOG_VERSION_PATH)
+    ContentType.objects.clear_cache()
+    snapshot._snapshot = None
+    autocomplete._index = None
+
+
+class TemporaryFilesMixin:
+    """Снимок каталога и медиафайлы тестов во временном каталоге"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = tempfile.mkdtemp()
+        cls.settings_override = override_settings(
+            CATALOG_SNAPSHOT_PATH=f'{cls.temp_dir}/catalog.snapshot',
+            CATALOG_VERSION_PATH=f'{cls.temp_dir}/catalog.version',
+            MEDIA_ROOT=f'{cls.temp_dir}/media',
+            CHUNKED_UPLOAD_DIR=f'{cls.temp_dir}/uploads',
+            PDF_PROCESS_IN_BACKGROUND=False,
+            RATELIMIT_ALLOW_LOCAL_CACHE=True,
+        )
+        cls.settings_override.enable()
+        # Счетчики лимитов общие для всего прогона, тесты одного класса начинают с нуля
+        caches[settings.RATELIMIT_CACHE].clear()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.settings_override.disable()
+        shutil.rmtree(cls.temp_dir, ignore_errors=True)
+
+
+class QueryBudgetTests(TemporaryFilesMixin, TestCase):
+    def setUp(self):
+        self.reader = User.objects.create_user('reader', password='password')
+        self.other = User.objects.create_user('other', password='password')
+        self.staff = User.objects.create_superuser('staff', password='password')
+        self.scale = 0
+        self.book = None
+        self.spare_books = []
+
+    def seed(self, size):
+        """Догружает каталог до масштаба size: на каждую единицу автор, жанр и две книги"""
+        today = timezone.now().date()
+        for number in range(self.scale, size):
+            author = Author.objects.create(name=f'Автор {number}')
+            genre = Genre.objects.create(name=f'Жанр {number}')
+            books = [
+                Book.objects.create(title=f'Книга {number}-{index}', author=author,
+                                    description=f'Описание книги {number} {index}')
+                for index in range(2)
+            ]
+            for book in books:
+                book.genres.add(genre, *Genre.objects.order_by('pk')[:1])
+                Favorite.objects.create(user=self.other, book=book)
+                FavoriteRollup.objects.create(book=book, day=today - timedelta(days=number % 7), adds=number + 1)
+            Favorite.objects.create(user=self.reader, book=books[0])
+            # Рекомендации пока строятся по старой связи favorited_by
+            books[0].favorited_by.add(self.reader)
+            FavoriteRemoval.objects.create(book=books[1], favorite_id=number)
+            ChunkedUpload.objects.create(user=self.staff, book=books[0], filename=f'{number}.txt', total_size=1)
+            if self.book is None:
+                self.book = books[0]
+            else:
+                SimilarBook.objects.create(book=self.book, similar=books[0], score=1 / (number + 1), rank=number)
+            self.spare_books.append(books[1])
+        self.scale = size
+
+    def assertQueriesDoNotScale(self, request):
+        """Вызывает request(client) на каждом размере и сравнивает запросы к базе
+
+        Каталог только растет, поэтому проверка делается один раз на тест.
+        """
+        runs = []
+        for size in SIZES:
+            self.seed(size)
+            reset_caches()
+            with CaptureQueriesContext(connection) as queries:
+                response = request(self.client)
+            self.assertLess(response.status_code, 400, f'Ответ {response.status_code} на масштабе {size}')
+            runs.append(Counter(fingerprint(query['sql']) for query in queries.captured_queries))
+
+        small, large = runs
+        if sum(small.values()) != sum(large.values()):
+            grown = [
+                f'  {small[sql]} -> {large[sql]}: {sql}'
+                for sql in sorted(large) if large[sql] > small[sql]
+            ]
+            self.fail(
+                f'Число запросов растет с объемом данных: {sum(small.values())} на масштабе {SIZES[0]}, '
+                f'{sum(large.values())} на масштабе {SIZES[1]}\n' + '\n'.join(grown)
+            )
+
+    def get(self, name, *args, **params):
+        return lambda client: client.get(reverse(name, args=args), params)
+
+    def login(self, user):
+        self.client.force_login(user)
+
+    # Каталог
+
+    def test_home_anonymous(self):
+        self.assertQueriesDoNotScale(self.get('home'))
+
+    def test_home_authenticated(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(self.get('home'))
+
+    def test_book_list_anonymous(self):
+        self.assertQueriesDoNotScale(self.get('book_list'))
+
+    def test_book_list_authenticated(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(self.get('book_list'))
+
+    def test_book_list_filtered(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(lambda client: client.get(
+            reverse('book_list'), {'q': 'Книга', 'genre': Genre.objects.order_by('pk')[0].pk}
+        ))
+
+    def test_book_detail_anonymous(self):
+        self.assertQueriesDoNotScale(lambda client: client.get(reverse('book_detail', args=[self.book.pk])))
+
+    def test_book_detail_authenticated(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(lambda client: client.get(reverse('book_detail', args=[self.book.pk])))
+
+    def test_read_book(self):
+        self.assertQueriesDoNotScale(lambda client: client.get(reverse('read_book', args=[self.book.pk])))
+
+    def test_autocomplete(self):
+        self.assertQueriesDoNotScale(self.get('autocomplete', q='кни'))
+
+    # Пользователь
+
+    def test_profile(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(self.get('profile'))
+
+    def test_edit_profile(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(self.get('edit_profile'))
+
+    def test_login_page(self):
+        self.assertQueriesDoNotScale(self.get('login'))
+
+    def test_register_page(self):
+        self.assertQueriesDoNotScale(self.get('register'))
+
+    def test_toggle_favorite(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(
+            lambda client: client.post(reverse('toggle_favorite', args=[self.spare_books[-1].pk]))
+        )
+
+    def test_favorites_batch(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(lambda client: client.post(reverse('favorites_batch'), {
+            'action': 'add', 'book': [book.pk for book in self.spare_books],
+        }))
+
+    def test_favorites_clear(self):
+        self.login(self.reader)
+        self.assertQueriesDoNotScale(lambda client: client.post(reverse('favorites_batch'), {'action': 'clear'}))
+
+    # Админка
+
+    def assertChangelistDoesNotScale(self, model):
+        self.login(self.staff)
+        self.assertQueriesDoNotScale(self.get(f'admin:library_{model}_changelist'))
+
+    def test_admin_books(self):
+        self.assertChangelistDoesNotScale('book')
+
+    def test_admin_authors(self):
+        self.assertChangelistDoesNotScale('author')
+
+    def test_admin_genres(self):
+        self.assertChangelistDoesNotScale('genre')
+
+    def test_admin_favorites(self):
+        self.assertChangelistDoesNotScale('favorite')
+
+    def test_admin_chunked_uploads(self):
+        self.assertChangelistDoesNotScale('chunkedupload')
+
+    def test_admin_favorite_rollups(self):
+        self.assertChangelistDoesNotScale('favoriterollup')
+
+    def test_admin_book_change(self):
+        self.login(self.staff)
+        self.assertQueriesDoNotScale(
+            lambda client: client.get(reverse('admin:library_book_change', args=[self.book.pk]))
+        )
+
+
+class StoredFileTests(TemporaryFilesMixin, TestCase):
+    def test_file_deleted_before_acquire_is_saved_again(self):
+        """Другая транзакция удалила файл между дедупликацией и acquire"""
+        book = Book.objects.create(title='Книга', author=Author.objects.create(name='Автор'))
+        acquire = StoredFile.acquire.__func__
+
+        def acquire_after_delete(cls, name):
+            book_storage.delete(name)
+            acquire(cls, name)
+
+        with mock.patch.object(StoredFile, 'acquire', classmethod(acquire_after_delete)), \
+                self.captureOnCommitCallbacks(execute=True):
+            book.book_file = ContentFile(b'text of the book', name='book.fb2')
+            book.save()
+
+        self.assertEqual(StoredFile.objects.get(name=book.book_file.name).ref_count, 1)
+        with book_storage.open(book.book_file.name) as stored:
+            self.assertEqual(stored.read(), b'text of the book')
+
+    def test_refreshed_book_does_not_count_files_again(self):
+        book = Book.objects.create(title='Книга', author=Author.objects.create(name='Автор'))
+        other = Book.objects.get(pk=book.pk)
+        other.web_file = ContentFile(b'%PDF-1.4 linearized', name='web.pdf')
+        other.save(update_fields=['web_file'])
+
+        book.refresh_from_db()
+        book.save()
+        deferred = Book.objects.defer('web_file').get(pk=book.pk)
+        deferred.web_file
+        deferred.save()
+
+        self.assertEqual(StoredFile.objects.get(name=other.web_file.name).ref_count, 1)
+
+
+class ChunkedUploadTests(TemporaryFilesMixin, TestCase):
+    content = 'Глава первая\n'.encode() * 100
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser('staff', password='password'))
+        self.book = Book.objects.create(title='Книга', author=Author.objects.create(name='Автор'))
+
+    def start(self, **fields):
+        data = {'book': self.book.pk, 'filename': 'book.fb2', 'size': len(self.content),
+                'sha256': hashlib.sha256(self.content).hexdigest()}
+        data.update(fields)
+        return self.client.post(reverse('upload_start'), data)
+
+    def send(self, upload_id, offset, chunk, **headers):
+        return self.client.post(
+            reverse('upload_chunk', args=[upload_id]), chunk, content_type='application/octet-stream',
+            HTTP_X_UPLOAD_OFFSET=str(offset), **headers,
+        )
+
+    def test_file_checksum_is_required(self):
+        response = self.start(sha256='')
+        self.assertEqual(response.status_code, 400)
+
+    def test_chunk_checksum_is_required(self):
+        upload_id = self.start().json()['upload_id']
+        response = self.send(upload_id, 0, self.content)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(ChunkedUpload.objects.get(upload_id=upload_id).offset, 0)
+
+    def test_upload_is_verified_against_file_checksum(self):
+        upload_id = self.start(sha256='0' * 64).json()['upload_id']
+        response = self.send(upload_id, 0, self.content,
+                             HTTP_X_CHUNK_SHA256=hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse('upload_complete', args=[upload_id]))
+        self.assertEqual(response.status_code, 400)
+        self.book.refresh_from_db()
+        self.assertFalse(self.book.book_file)
+
+    def test_complete_upload(self):
+        upload_id = self.start().json()['upload_id']
+        self.send(upload_id, 0, self.content, HTTP_X_CHUNK_SHA256=hashlib.sha256(self.content).hexdigest())
+        response = self.client.post(reverse('upload_complete', args=[upload_id]))
+        self.assertEqual(response.status_code, 200)
+        self.book.refresh_from_db()
+        with self.book.book_file.open('rb') as stored:
+            self.assertEqual(stored.read(), self.content)
+
+
+    def test_missing_temp_file_is_gone(self):
+        upload_id = self.start().json()['upload_id']
+        os.remove(ChunkedUpload.objects.get(upload_id=upload_id).temp_path)
+        response = self.send(upload_id, 0, self.content,
+                             HTTP_X_CHUNK_SHA256=hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(response.status_code, 410)
+        self.assertFalse(ChunkedUpload.objects.filter(upload_id=upload_id).exists())
+
+        upload_id = self.start().json()['upload_id']
+        os.remove(ChunkedUpload.objects.get(upload_id=upload_id).temp_path)
+        response = self.client.post(reverse('upload_complete', args=[upload_id]))
+        self.assertEqual(response.status_code, 410)
+
+    def test_gc_media_deletes_abandoned_uploads(self):
+        abandoned = ChunkedUpload.objects.get(upload_id=self.start().json()['upload_id'])
+        active = ChunkedUpload.objects.get(upload_id=self.start(filename='other.fb2').json()['upload_id'])
+        orphan = os.path.join(settings.CHUNKED_UPLOAD_DIR, 'orphan.part')
+        open(orphan, 'wb').close()
+        day_ago = timezone.now() - timedelta(days=2)
+        ChunkedUpload.objects.filter(pk=abandoned.pk).update(updated_at=day_ago)
+        for path in (abandoned.temp_path, orphan):
+            os.utime(path, (day_ago.timestamp(), day_ago.timestamp()))
+
+        call_command('gc_media', delete=True, stdout=io.StringIO())
+
+        self.assertFalse(ChunkedUpload.objects.filter(pk=abandoned.pk).exists())
+        self.assertFalse(os.path.exists(abandoned.temp_path))
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(active.temp_path))
+
+
+class FavoritesBatchTests(TemporaryFilesMixin, TestCase):
+    def setUp(self):
+        self.reader = User.objects.create_user('reader', password='password')
+        self.other = User.objects.create_user('other', password='password')
+        author = Author.objects.create(name='Автор')
+        self.books = [Book.objects.create(title=f'Книга {number}', author=author) for number in range(4)]
+        self.client.force_login(self.reader)
+
+    def batch(self, action, books=()):
+        return self.client.post(reverse('favorites_batch'), {'action': action, 'book': [str(pk) for pk in books]})
+
+    def favorites(self, user=None):
+        return set(Favorite.objects.filter(user=user or self.reader).values_list('book_id', flat=True))
+
+    def test_add_skips_existing_and_unknown_books(self):
+        Favorite.objects.create(user=self.reader, book=self.books[0])
+        response = self.batch('add', [self.books[0].pk, self.books[1].pk, 999999])
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.favorites(), {self.books[0].pk, self.books[1].pk})
+
+    def test_remove_logs_removed_favorites(self):
+        kept = Favorite.objects.create(user=self.reader, book=self.books[2])
+        removed = Favorite.objects.create(user=self.reader, book=self.books[0])
+        Favorite.objects.create(user=self.other, book=self.books[0])
+        self.batch('remove', [self.books[0].pk, self.books[1].pk, 999999])
+        self.assertEqual(self.favorites(), {kept.book_id})
+        self.assertEqual(self.favorites(self.other), {self.books[0].pk})
+        self.assertEqual(
+            list(FavoriteRemoval.objects.values_list('book_id', 'favorite_id')), [(self.books[0].pk, removed.pk)]
+        )
+
+    def test_clear_removes_all_favorites_in_one_delete(self):
+        for book in self.books:
+            Favorite.objects.create(user=self.reader, book=book)
+        Favorite.objects.create(user=self.other, book=self.books[0])
+        with CaptureQueriesContext(connection) as queries:
+            self.batch('clear')
+        self.assertEqual(self.favorites(), set())
+        self.assertEqual(self.favorites(self.other), {self.books[0].pk})
+        self.assertEqual(FavoriteRemoval.objects.count(), len(self.books))
+        deletes = [query['sql'] for query in queries.captured_queries if query['sql'].startswith('DELETE')]
+        self.assertEqual(len(deletes), 1)
+
+    def test_books_are_required_except_for_clear(self):
+        Favorite.objects.create(user=self.reader, book=self.books[0])
+        self.batch('remove')
+        self.batch('unknown', [self.books[0].pk])
+        self.assertEqual(self.favorites(), {self.books[0].pk})
+
+
+class TextStoreTests(SimpleTestCase):
+    text = ''.join(f'Строка {number}: съешь же ещё этих мягких французских булок\n' for number in range(40)).encode()
+
+    def compress(self, data, frame_size):
+        target = io.BytesIO()
+        self.assertEqual(textstore.compress_text(io.BytesIO(data), target, frame_size), len(data))
+        return textstore.CompressedText(target)
+
+    def test_split_point_keeps_lines_and_characters_whole(self):
+        self.assertEqual(textstore._split_point('ab\nвгд'.encode(), 6), 3)
+        # Без перевода строки кадр режется перед продолжением символа UTF-8
+        self.assertEqual(textstore._split_point('абв'.encode(), 3), 2)
+        self.assertEqual(textstore._split_point(b'abcdef', 3), 3)
+
+    def test_multi_frame_round_trip(self):
+        text = self.compress(self.text, 200)
+        self.assertGreater(text.frame_count, 10)
+        self.assertEqual(b''.join(text.iter_range()), self.text)
+        for number in range(text.frame_count):
+            self.assertTrue(text.read_frame(number).endswith(b'\n'))
+            text.read_frame(number).decode('utf-8')
+
+    def test_line_longer_than_frame_is_split_on_character_boundary(self):
+        data = 'щ'.encode() * 301 + b'\n'
+        text = self.compress(data, 64)
+        self.assertEqual(b''.join(text.iter_range()), data)
+        for number in range(text.frame_count):
+            text.read_frame(number).decode('utf-8')
+
+    def test_ranges_across_frames(self):
+        text = self.compress(self.text, 200)
+        for start, end in [(0, 1), (150, 250), (199, 201), (37, 1500), (len(self.text) - 3, None), (10, 10 ** 9)]:
+            self.assertEqual(b''.join(text.iter_range(start, end)), self.text[start:end])
+        self.assertEqual(b''.join(text.iter_range(500, 400)), b'')
+
+
+class DownloadBookTests(TemporaryFilesMixin, TestCase):
+    text = ''.join(f'Глава {number}. Всё смешалось в доме Облонских.\n' for number in range(3000)).encode()
+
+    def setUp(self):
+        self.book = Book.objects.create(
+            title='Анна Каренина', author=Author.objects.create(name='Толстой'),
+            book_file=ContentFile(self.text, name='anna.txt'),
+        )
+
+    def download(self, **headers):
+        response = self.client.get(reverse('download_book', args=[self.book.pk]), **headers)
+        return response, b''.join(response.streaming_content) if response.streaming else response.content
+
+    def test_text_is_stored_compressed_in_several_frames(self):
+        self.assertTrue(self.book.book_file.name.endswith(textstore.EXTENSION))
+        with self.book.book_file.open('rb') as book_file:
+            self.assertGreater(textstore.CompressedText(book_file).frame_count, 1)
+
+    def test_full_download(self):
+        response, body = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(body, self.text)
+        self.assertEqual(response['Content-Length'], str(len(self.text)))
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+
+    def test_byte_ranges(self):
+        size = len(self.text)
+        frame = textstore.FRAME_SIZE
+        for header, start, end in [
+            ('bytes=10-99', 10, 100),
+            (f'bytes={frame - 5}-{frame + 5}', frame - 5, frame + 6),
+            (f'bytes={frame * 2}-', frame * 2, size),
+            ('bytes=-50', size - 50, size),
+            (f'bytes=100-{size * 2}', 100, size),
+        ]:
+            response, body = self.download(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206, header)
+            self.assertEqual(body, self.text[start:end], header)
+            self.assertEqual(response['Content-Range'], f'bytes {start}-{end - 1}/{size}', header)
+            self.assertEqual(response['Content-Length'], str(end - start), header)
+
+    def test_unsatisfiable_range(self):
+        response, _ = self.download(HTTP_RANGE=f'bytes={len(self.text)}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{len(self.text)}')
+
+    def test_unsupported_ranges_return_whole_text(self):
+        for header in ('bytes=0-1,5-6', 'lines=1-2', 'bytes=a-b'):
+            response, body = self.download(HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 200, header)
+            self.assertEqual(body, self.text, header)
+
+
+class SimilarityUpdateTests(TemporaryFilesMixin, TestCase):
+    def test_book_save_updates_similarity_once(self):
+        """Сохранение книги в админке с жанрами пересчитывает соседей один раз"""
+        with self.captureOnCommitCallbacks(execute=True):
+            genres = [Genre.objects.create(name=f'Жанр {number}') for number in range(3)]
+            book = Book.objects.create(title='Книга', author=Author.objects.create(name='Автор'))
+            book.genres.set(genres[:2])
+        self.client.force_login(User.objects.create_superuser('staff', password='password'))
+
+        with mock.patch('library.similarity.update_similar_books') as update, \
+                self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('admin:library_book_change', args=[book.pk]), {
+                'title': 'Книга', 'author': book.author_id, 'description': 'Новое описание',
+                'genres': [genres[1].pk, genres[2].pk],
+            })
+        self.assertEqual(response.status_code, 302)
+        update.assert_called_once_with([book.pk])
+
+    def test_only_changed_books_are_tokenized_again(self):
+        author = Author.objects.create(name='Автор')
+        books = [
+            Book.objects.create(title=f'Книга {word}', author=author, description=f'Повесть про {word} и море')
+            for word in ('капитана', 'рыбака', 'шторм', 'маяк')
+        ]
+        similarity.build_matrix()
+
+        books[0].description = 'Повесть про шторм, маяк и рыбака'
+        books[0].save()
+        with mock.patch('library.similarity.book_tokens', wraps=similarity.book_tokens) as tokens:
+            ids, matrix = similarity.build_matrix()
+        self.assertEqual([call.args[0].pk for call in tokens.call_args_list], [books[0].pk])
+
+        similarity._term_counts.clear()
+        fresh_ids, fresh = similarity.build_matrix()
+        self.assertEqual(list(ids), list(fresh_ids))
+        # Номера терминов в словарях разные, а сходства книг совпадают
+        self.assertTrue(np.allclose((matrix @ matrix.T).toarray(), (fresh @ fresh.T).toarray(), atol=1e-6))
+
+
+BUMP_SCRIPT = """
+import sys
+import django
+django.setup()
+from django.conf import settings
+settings.CATALOG_VERSION_PATH = sys.argv[1]
+from library.caching import bump_catalog_version
+bump_catalog_version()
+"""
+
+
+class CatalogVersionTests(TemporaryFilesMixin, TestCase):
+    """Изменение каталога в другом процессе видно этому процессу"""
+
+    def setUp(self):
+        reset_caches()
+        self.author = Author.objects.create(name='Автор')
+        Book.objects.create(title='Первая книга', author=self.author)
+
+    def change_catalog_in_other_process(self):
+        # В TestCase колбэки on_commit не выполняются, поэтому сам тест версию не поднимает
+        subprocess.run(
+            [sys.executable, '-c', BUMP_SCRIPT, settings.CATALOG_VERSION_PATH],
+            check=True, cwd=settings.BASE_DIR,
+        )
+
+    def test_write_in_other_process_invalidates_page(self):
+        etag = self.client.get(reverse('home'))['ETag']
+        self.assertEqual(self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        Book.objects.create(title='Новая книга', author=self.author)
+        self.assertNotContains(self.client.get(reverse('home')), 'Новая книга')
+
+        self.change_catalog_in_other_process()
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertContains(response, 'Новая книга')
+
+    def test_rollup_updates_trending_on_cached_page(self):
+        book = Book.objects.get(title='Первая книга')
+        etag = self.client.get(reverse('home'))['ETag']
+
+        # Команда работает в отдельном процессе из cron со своим кэшем в памяти
+        Favorite.objects.create(user=User.objects.create_user('reader'), book=book)
+        with override_settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'cron',
+        }}):
+            call_command('rollup_favorites', stdout=io.StringIO())
+
+        response = self.client.get(reverse('home'), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([trending.pk for trending in response.context['trending_week']], [book.pk])
+
+    def suggestions(self, query):
+        response = self.client.get(reverse('autocomplete'), {'q': query})
+        return [item['label'] for item in response.json()['suggestions']]
+
+    def test_autocomplete_index_follows_other_process(self):
+        self.assertEqual(self.suggestions('нов'), [])
+
+        Book.objects.create(title='Новая книга', author=self.author)
+        self.assertEqual(self.suggestions('нов'), [])
+
+        self.change_catalog_in_other_process()
+        self.assertEqual(self.suggestions('нов'), ['Новая книга'])
+
+    def test_snapshot_remaps_file_rebuilt_by_other_process(self):
+        self.assertEqual(snapshot.get_snapshot().genres(), [])
+
+        Genre.objects.create(name='Новый жанр')
+        self.change_catalog_in_other_process()
+        # Другой воркер уже пересобрал файл под новую версию
+        snapshot.build_snapshot(settings.CATALOG_SNAPSHOT_PATH, get_catalog_version())
+
+        with mock.patch('library.snapshot.build_snapshot') as build:
+            names = [genre.name for genre in snapshot.get_snapshot().genres()]
+        build.assert_not_called()
+        self.assertEqual(names, ['Новый жанр'])
+
+    def test_card_is_not_cached_with_genres_from_older_snapshot(self):
+        self.client.force_login(User.objects.create_user('reader'))
+        self.client.get(reverse('book_list'))
+
+        # Книга появилась после того, как view взял снимок, но до рендера карточек
+        book = Book.objects.create(title='Новая книга', author=self.author)
+        book.genres.add(Genre.objects.create(name='Фантастика'))
+        self.assertNotContains(self.client.get(reverse('book_list')), 'Фантастика')
+
+        self.change_catalog_in_other_process()
+        # Жанр в списке слева и на карточке книги
+        self.assertContains(self.client.get(reverse('book_list')), 'Фантастика', count=2)
+
+
+@override_settings(
+    RATELIMIT_ALLOW_LOCAL_CACHE=True,
+    RATELIMITS={'login': {'rate': '10/m', 'methods': ['POST']}},
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+)
+class BookCardCacheTests(TemporaryFilesMixin, TestCase):
+    """Кэш карточек книг: версия книги в ключе, избранное вне кэша"""
+
+    def setUp(self):
+        reset_caches()
+        self.reader = User.objects.create_user('reader')
+        self.genre = Genre.objects.create(name='Роман')
+        self.author = Author.objects.create(name='Лев Толстой')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book = Book.objects.create(title='Анна Каренина', author=self.author, description='Все счастливые семьи')
+            self.book.genres.add(self.genre)
+        self.client.force_login(self.reader)
+
+    def card(self):
+        return self.client.get(reverse('book_list')).content.decode()
+
+    def test_author_rename_changes_card(self):
+        self.assertIn('Лев Толстой', self.card())
+        # Без колбэков on_commit версия каталога не меняется: карточку обновляет версия книги
+        self.author.name = 'Л. Н. Толстой'
+        self.author.save()
+        self.assertIn('Л. Н. Толстой', self.card())
+
+    def test_genre_change_changes_card(self):
+        self.assertIn('Роман', self.card())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.genre.name = 'Семейный роман'
+            self.genre.save()
+        self.assertIn('Семейный роман', self.card())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.book.genres.remove(self.genre)
+        self.assertNotIn('badge bg-primary">Семейный роман', self.card())
+
+    def test_favorite_state_is_per_user_on_cached_card(self):
+        Favorite.objects.create(user=self.reader, book=self.book)
+        self.assertIn('title="Удалить из избранного"', self.card())
+
+        # Описание меняется мимо updated_at: если карточка из кэша, на странице старое
+        Book.objects.filter(pk=self.book.pk).update(description='Изменено в обход версии')
+        self.client.force_login(User.objects.create_user('other'))
+        page = self.card()
+        self.assertIn('Все счастливые семьи', page)
+        self.assertIn('title="Добавить в избранное"', page)
+        self.assertNotIn('title="Удалить из избранного"', page)
+
+
+class RateLimitTests(TestCase):
+    def setUp(self):
+        caches[settings.RATELIMIT_CACHE].clear()
+
+    def post_login(self, now):
+        with mock.patch('library.ratelimit.time.time', return_value=now):
+            return self.client.post(reverse('login'), {'username': 'reader', 'password': 'wrong'})
+
+    def test_process_local_cache_is_rejected(self):
+        with override_settings(RATELIMIT_ALLOW_LOCAL_CACHE=False):
+            with self.assertRaises(ImproperlyConfigured):
+                RateLimitMiddleware(lambda request: None)
+
+    def test_login_is_limited_with_retry_after(self):
+        statuses = [self.post_login(6000 + second).status_code for second in range(10)]
+        self.assertEqual(statuses, [200] * 10)
+
+        response = self.post_login(6010)
+        self.assertEqual(response.status_code, 429)
+        # Первый запрос выходит из последней минуты в 6060
+        self.assertEqual(response['Retry-After'], '50')
+        self.assertEqual(self.client.get(reverse('login')).status_code, 200)
+
+    def test_no_double_limit_at_window_boundary(self):
+        for _ in range(10):
+            self.assertEqual(self.post_login(6059.5).status_code, 200)
+        # Фиксированное окно пропустило бы здесь еще 10 запросов
+        self.assertEqual(self.post_login(6060.5).status_code, 429)
+        self.assertEqual(self.post_login(6119.5).status_code, 200)
+
+    def test_processes_share_limit_through_leases(self):
+        rule = parse_rule({'rate': '100/m', 'lease': 10})
+        workers = [RateLimitMiddleware(lambda request: None) for _ in range(2)]
+        cache = caches[settings.RATELIMIT_CACHE]
+        with mock.patch('library.ratelimit.time.time', return_value=6000), \
+                mock.patch.object(cache, 'incr', wraps=cache.incr) as incr:
+            allowed = [workers[number % 2].consume('login', 'ip:127.0.0.1', rule) for number in range(100)]
+            # Разрешенные запросы берут токены из кэша пачками по 10; первый incr
+            # повторяется после создания ключа
+            self.assertEqual(incr.call_count, 10 + 1)
+            denied = [workers[number % 2].consume('login', 'ip:127.0.0.1', rule) for number in range(10)]
+        self.assertEqual(allowed, [0] * 100)
+        self.assertNotIn(0, denied)
+
+
+class PdfProcessingTests(TemporaryFilesMixin, TestCase):
+    def pdf(self, pages):
+        import pikepdf
+
+        document = pikepdf.new()
+        for number in range(pages):
+            document.add_blank_page(page_size=(200 + number, 300))
+        output = io.BytesIO()
+        document.save(output)
+        return ContentFile(output.getvalue(), name='book.pdf')
+
+    def test_page_images_are_deleted_with_book(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            book = Book.objects.create(title='Книга', author=Author.objects.create(name='Автор'),
+                                       book_file=self.pdf(2))
+        self.assertTrue(process_book_pdf(book.pk))
+        images = list(book.pages.values_list('image', flat=True))
+        self.assertEqual(len(images), 2)
+        for name in images:
+            self.assertEqual(StoredFile.objects.get(name=name).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Book.objects.get(pk=book.pk).delete()
+        for name in images:
+            self.assertFalse(book_storage.exists(name))
+
+    def test_replaced_file_drops_old_web_copy_and_pages(self):
+        book = Book.objects.create(title='Книга', author=Author.objects.create(name='Автор'))
+        book.book_file = ContentFile(b'%PDF-1.4 old', name='old.pdf')
+        book.web_file = ContentFile(b'%PDF-1.4 old linearized', name='web.pdf')
+        book.save()
+        book.processed_file = book.book_file.name
+        book.save(update_fields=['processed_file'])
+        BookPage.objects.create(book=book, number=1, image=ContentFile(b'jpeg', name='1.jpg'))
+        old_web = book.web_file.name
+        self.assertEqual(book.reader_file.name, old_web)
+
+        book = Book.objects.get(pk=book.pk)
+        book.book_file = ContentFile(b'%PDF-1.4 new', name='new.pdf')
+        book.save(update_fields=['book_file'])
+
+        book = Book.objects.get(pk=book.pk)
+        self.assertEqual(book.reader_file.name, book.book_file.name)
+        self.assertFalse(book.web_file)
+        self.assertFalse(book.pages.exists())
+        self.assertEqual(StoredFile.objects.get(name=old_web).ref_count, 0)
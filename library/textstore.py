@@ -0,0 +1,121 @@
+"""Сжатое хранение текстовых книг с произвольным доступом.
+
+Текст режется на кадры примерно по FRAME_SIZE байт по границам строк, и
+каждый кадр сжимается zlib независимо от остальных. В конце файла лежит
+таблица кадров: смещение кадра в тексте, в файле и его сжатый размер.
+Чтобы прочитать часть текста, распаковываются только кадры, которые ее
+покрывают, поэтому читалка и скачивание не держат в памяти всю книгу.
+"""
+import struct
+import tempfile
+import zlib
+from bisect import bisect_right
+
+from django.core.files import File
+
+MAGIC = b'LIBTXTZ1'
+HEADER = struct.Struct('<8sIIQQ')
+FRAME_ENTRY = struct.Struct('<QQI')
+FRAME_SIZE = 64 * 1024
+COMPRESSION_LEVEL = 9
+EXTENSION = '.txtz'
+
+
+def is_plain_text(name):
+    return bool(name) and name.lower().endswith('.txt')
+
+
+def is_compressed_text(name):
+    return bool(name) and name.lower().endswith(EXTENSION)
+
+
+def _split_point(buffer, size):
+    """Конец кадра: после последнего перевода строки или на границе символа UTF-8"""
+    cut = buffer.rfind(b'\n', 0, size) + 1
+    if cut:
+        return cut
+    cut = size
+    while cut > 0 and buffer[cut] & 0xC0 == 0x80:
+        cut -= 1
+    return cut or size
+
+
+def iter_frames(source, frame_size=FRAME_SIZE):
+    buffer = b''
+    while True:
+        block = source.read(frame_size)
+        if block:
+            buffer += block
+        while len(buffer) > frame_size or (not block and buffer):
+            cut = _split_point(buffer, frame_size) if len(buffer) > frame_size else len(buffer)
+            yield buffer[:cut]
+            buffer = buffer[cut:]
+        if not block:
+            return
+
+
+def compress_text(source, target, frame_size=FRAME_SIZE):
+    """Пишет текст из source в target в сжатом формате с таблицей кадров"""
+    target.write(HEADER.pack(MAGIC, frame_size, 0, 0, 0))
+    entries = []
+    text_offset = 0
+    for frame in iter_frames(source, frame_size):
+        data = zlib.compress(frame, COMPRESSION_LEVEL)
+        entries.append(FRAME_ENTRY.pack(text_offset, target.tell(), len(data)))
+        target.write(data)
+        text_offset += len(frame)
+
+    index_offset = target.tell()
+    target.write(b''.join(entries))
+    target.seek(0)
+    target.write(HEADER.pack(MAGIC, frame_size, len(entries), text_offset, index_offset))
+    target.seek(0, 2)
+    return text_offset
+
+
+def compressed_copy(field_file):
+    """Сжатая копия текстового файла книги для сохранения в хранилище"""
+    name = field_file.name.rsplit('/', 1)[-1]
+    target = tempfile.TemporaryFile()
+    field_file.open('rb')
+    try:
+        compress_text(field_file, target)
+    finally:
+        field_file.close()
+    target.seek(0)
+    return File(target, name=name[:-len('.txt')] + EXTENSION)
+
+
+class CompressedText:
+    """Чтение диапазонов текста из сжатого файла"""
+
+    def __init__(self, file):
+        self.file = file
+        file.seek(0)
+        magic, self.frame_size, self.frame_count, self.size, index_offset = HEADER.unpack(file.read(HEADER.size))
+        if magic != MAGIC:
+            raise ValueError('Файл не является сжатым текстом книги')
+        file.seek(index_offset)
+        table = file.read(FRAME_ENTRY.size * self.frame_count)
+        self.frames = list(FRAME_ENTRY.iter_unpack(table))
+        self.starts = [text_offset for text_offset, _, _ in self.frames]
+
+    def read_frame(self, number):
+        _, offset, size = self.frames[number]
+        self.file.seek(offset)
+        return zlib.decompress(self.file.read(size))
+
+    def frame_text(self, number):
+        return self.read_frame(number).decode('utf-8', errors='replace')
+
+    def iter_range(self, start=0, end=None):
+        """Байты текста [start, end), распакованные по одному кадру"""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        number = bisect_right(self.starts, start) - 1
+        while number < self.frame_count and self.starts[number] < end:
+            frame_start = self.starts[number]
+            frame = self.read_frame(number)
+            yield frame[max(0, start - frame_start):end - frame_start]
+            number += 1
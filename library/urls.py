@@ -5,12 +5,18 @@ from django.contrib.auth import views as auth_views
 urlpatterns = [
     path('', views.home, name='home'),
     path('books/', views.book_list, name='book_list'),
+    path('books/autocomplete/', views.autocomplete, name='autocomplete'),
     path('books/<int:pk>/', views.book_detail, name='book_detail'),
     path('profile/', views.profile, name='profile'),
     path('register/', views.register_view, name='register'),
     path('login/', views.login_view, name='login'),
     path('logout/', views.logout_view, name='logout'),
     path('toggle_favorite/<int:book_id>/', views.toggle_favorite, name='toggle_favorite'),
+    path('favorites/batch/', views.favorites_batch, name='favorites_batch'),
     path('books/<int:pk>/read/', views.read_book, name='read_book'),
+    path('books/<int:pk>/download/', views.download_book, name='download_book'),
      path('profile/edit/', views.edit_profile, name='edit_profile'),
+    path('uploads/', views.upload_start, name='upload_start'),
+    path('uploads/<uuid:upload_id>/', views.upload_chunk, name='upload_chunk'),
+    path('uploads/<uuid:upload_id>/complete/', views.upload_complete, name='upload_complete'),
 ]
\ No newline at end of file
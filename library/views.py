@@ -1,49 +1,75 @@
+import hashlib
+import os
+import re
+import zlib
+from urllib.parse import quote
 from django.shortcuts import render, get_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.files import File
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST, require_http_methods
 from django.db.models import Q
 from django.contrib.auth.forms import UserCreationForm, AuthenticationForm
 from django.contrib.auth import login, logout
+from django.db import transaction
 from django.contrib import messages
-from .models import Book, Author, Genre, Favorite, Profile
+from django.utils import timezone
+from .models import Book, Author, Genre, Favorite, Profile, ChunkedUpload, FavoriteRemoval, get_trending_books
+from .caching import catalog_page
+from .autocomplete import suggest
+from .snapshot import get_snapshot
+from .textstore import CompressedText, is_compressed_text
 from .forms import ProfileUpdateForm, UserUpdateForm
 from django.conf import settings
 
+@catalog_page
 def home(request):
-    genres = Genre.objects.all()
-    latest_books = Book.objects.order_by('-id')[:6]
-    total_books = Book.objects.count()
-    last_three_books = Book.objects.order_by('-id')[:3]
+    snapshot = get_snapshot()
+    genres = snapshot.genres()
+    latest_books = Book.objects.select_related('author').order_by('-id')[:6]
+    total_books = snapshot.total_books
+    last_three_books = Book.objects.select_related('author').order_by('-id')[:3]
     
     recommended_books = None
     user_favorite_genres = []
+    favorite_book_ids = set()
     
     if request.user.is_authenticated:
+        favorite_book_ids = set(
+            Favorite.objects.filter(user=request.user).values_list('book_id', flat=True)
+        )
         try:
             profile = request.user.profile
             recommended_books = profile.get_recommended_books()
             
-            favorite_books = request.user.favorite_books.all()
-            for book in favorite_books:
-                user_favorite_genres.extend(book.genres.all())
-            user_favorite_genres = list(set(user_favorite_genres))
+            user_favorite_genres = list(
+                Genre.objects.filter(book__favorited_by=request.user).distinct()
+            )
             
         except Profile.DoesNotExist:
             Profile.objects.create(user=request.user)
             recommended_books = Book.objects.order_by('-favorite_count')[:4]
     
     context = {
+        'snapshot': snapshot,
         'genres': genres,
         'latest_books': latest_books,
         'total_books': total_books,
         'last_three_books': last_three_books,
         'recommended_books': recommended_books,
         'user_favorite_genres': user_favorite_genres,
+        'favorite_book_ids': favorite_book_ids,
+        'trending_week': get_trending_books(days=7),
+        'trending_month': get_trending_books(days=30),
     }
     
     return render(request, 'library/home.html', context)
 
+@catalog_page
 def book_list(request):
-    books = Book.objects.all()
+    books = Book.objects.select_related('author')
     
     query = request.GET.get('q')
     if query:
@@ -59,30 +85,44 @@ def book_list(request):
     if author_id:
         books = books.filter(author__id=author_id)
     
-    authors = Author.objects.all()
-    genres = Genre.objects.all()
+    snapshot = get_snapshot()
+    authors = snapshot.authors()
+    genres = snapshot.genres()
     
-    favorite_books = []
+    favorite_books = set()
     if request.user.is_authenticated:
-        favorites = Favorite.objects.filter(user=request.user)
-        favorite_books = [fav.book.id for fav in favorites]
+        favorite_books = set(
+            Favorite.objects.filter(user=request.user).values_list('book_id', flat=True)
+        )
     
     return render(request, 'library/book_list.html', {
         'books': books,
+        'snapshot': snapshot,
         'genres': genres,
         'authors': authors,
         'favorite_books': favorite_books,
     })
 
+def autocomplete(request):
+    """Подсказки для строки поиска из индекса в памяти"""
+    query = request.GET.get('q', '')[:100]
+    return JsonResponse({'suggestions': suggest(query)})
+
+@catalog_page
 def book_detail(request, pk):
     book = get_object_or_404(Book, pk=pk)
     is_favorite = False
     if request.user.is_authenticated:
         is_favorite = Favorite.objects.filter(user=request.user, book=book).exists()
     
+    similar_books = book.similar_entries.select_related('similar', 'similar__author')
+    first_page = book.pages.first() if book.is_processed else None
+    
     return render(request, 'library/book_detail.html', {
         'book': book,
-        'is_favorite': is_favorite
+        'is_favorite': is_favorite,
+        'similar_books': similar_books,
+        'first_page': first_page,
     })
 
 def read_book(request, pk):
@@ -94,8 +134,27 @@ def read_book(request, pk):
         if file_extension == 'pdf':
             return render(request, 'library/read_book.html', {
                 'book': book,
-                'is_pdf': True
+                'is_pdf': True,
+                'pages': book.pages.all() if book.is_processed else [],
             })
+        elif file_extension == 'txtz':
+            # Страница читалки - один кадр сжатого файла, остальные не распаковываются
+            try:
+                with book.book_file.open('rb') as book_file:
+                    text = CompressedText(book_file)
+                    page_obj = Paginator(range(text.frame_count), 1).get_page(request.GET.get('page'))
+                    content = text.frame_text(page_obj.number - 1) if text.frame_count else ''
+                return render(request, 'library/read_book.html', {
+                    'book': book,
+                    'content': content,
+                    'page_obj': page_obj,
+                    'page_range': page_obj.paginator.get_elided_page_range(page_obj.number),
+                })
+            except (OSError, ValueError, zlib.error):
+                return render(request, 'library/read_book.html', {
+                    'book': book,
+                    'error': 'Ошибка чтения файла'
+                })
         elif file_extension == 'txt':
             try:
                 with open(book.book_file.path, 'r', encoding='utf-8') as file:
@@ -120,10 +179,78 @@ def read_book(request, pk):
             'error': 'Файл книги недоступен'
         })
 
+def _parse_range(header, size):
+    """Один диапазон из заголовка Range: (start, end) или None, если его нет"""
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) + 1 if last else size
+        else:
+            start, end = max(0, size - int(last)), size
+    except ValueError:
+        return None
+    if start >= size or end <= start:
+        raise ValueError('Диапазон вне файла')
+    return start, min(end, size)
+
+def _stream_text(book_file, text, start, end):
+    try:
+        yield from text.iter_range(start, end)
+    finally:
+        book_file.close()
+
+def download_book(request, pk):
+    """Отдает текст книги с распаковкой на лету и поддержкой Range"""
+    book = get_object_or_404(Book, pk=pk)
+    if not book.book_file:
+        raise Http404('Файл книги недоступен')
+    if not is_compressed_text(book.book_file.name):
+        return redirect(book.book_file.url)
+
+    book_file = book.book_file.open('rb')
+    text = CompressedText(book_file)
+    start, end, status = 0, text.size, 200
+    try:
+        requested = _parse_range(request.META.get('HTTP_RANGE', ''), text.size)
+    except ValueError:
+        book_file.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{text.size}'
+        return response
+    if requested:
+        (start, end), status = requested, 206
+
+    response = StreamingHttpResponse(
+        _stream_text(book_file, text, start, end), status=status,
+        content_type='text/plain; charset=utf-8',
+    )
+    response['Content-Length'] = str(end - start)
+    response['Accept-Ranges'] = 'bytes'
+    if status == 206:
+        response['Content-Range'] = f'bytes {start}-{end - 1}/{text.size}'
+    response['Content-Disposition'] = (
+        f"attachment; filename=\"book-{book.pk}.txt\"; filename*=UTF-8''{quote(book.title)}.txt"
+    )
+    return response
+
+FAVORITES_PER_PAGE = 12
+FAVORITE_SORTS = {'new': '-added_at', 'old': 'added_at'}
+
 @login_required
 def profile(request):
-    favorites = Favorite.objects.filter(user=request.user).select_related('book')
-    favorite_books = [favorite.book for favorite in favorites]
+    sort = request.GET.get('sort')
+    if sort not in FAVORITE_SORTS:
+        sort = 'new'
+    favorites = Favorite.objects.filter(user=request.user).select_related(
+        'book', 'book__author'
+    ).order_by(FAVORITE_SORTS[sort], '-id')
+    paginator = Paginator(favorites, FAVORITES_PER_PAGE)
+    page_obj = paginator.get_page(request.GET.get('page'))
+    favorite_books = [favorite.book for favorite in page_obj]
     
     try:
         profile = request.user.profile
@@ -137,7 +264,9 @@ def profile(request):
 
     context = {
         'favorite_books': favorite_books,
-        'favorites_count': len(favorite_books),
+        'favorites_count': paginator.count,
+        'page_obj': page_obj,
+        'sort': sort,
         'profile': profile,
         'profile_age_days': days_on_site,
     }
@@ -218,13 +347,197 @@ def logout_view(request):
 def toggle_favorite(request, book_id):
     book = get_object_or_404(Book, id=book_id)
     
-    favorite_exists = Favorite.objects.filter(user=request.user, book=book).exists()
+    favorite = Favorite.objects.filter(user=request.user, book=book).first()
     
-    if favorite_exists:
-        Favorite.objects.filter(user=request.user, book=book).delete()
+    if favorite:
+        FavoriteRemoval.objects.create(book=book, favorite_id=favorite.id)
+        favorite.delete()
         messages.success(request, f'Книга "{book.title}" удалена из избранного')
     else:
         Favorite.objects.create(user=request.user, book=book)
         messages.success(request, f'Книга "{book.title}" добавлена в избранное')
     
-    return redirect(request.META.get('HTTP_REFERER', 'home'))
\ No newline at end of file
+    return redirect(request.META.get('HTTP_REFERER', 'home'))
+
+@login_required
+@require_POST
+def favorites_batch(request):
+    """Добавляет или удаляет из избранного сразу несколько книг; clear очищает избранное"""
+    action = request.POST.get('action')
+    book_ids = {int(value) for value in request.POST.getlist('book') if value.isdigit()}
+    redirect_to = request.META.get('HTTP_REFERER', 'profile')
+    if action not in ('add', 'remove', 'clear') or (action != 'clear' and not book_ids):
+        messages.error(request, 'Не выбраны книги')
+        return redirect(redirect_to)
+
+    with transaction.atomic():
+        if action == 'add':
+            existing = list(Book.objects.filter(pk__in=book_ids).values_list('pk', flat=True))
+            Favorite.objects.bulk_create(
+                [Favorite(user=request.user, book_id=book_id) for book_id in existing],
+                ignore_conflicts=True,
+            )
+            messages.success(request, f'Книг добавлено в избранное: {len(existing)}')
+        else:
+            favorites = Favorite.objects.filter(user=request.user)
+            if action == 'remove':
+                favorites = favorites.filter(book_id__in=book_ids)
+            removed = list(favorites.values_list('pk', 'book_id'))
+            favorites.delete()
+            FavoriteRemoval.objects.bulk_create(
+                [FavoriteRemoval(book_id=book_id, favorite_id=pk) for pk, book_id in removed]
+            )
+            messages.success(request, f'Книг удалено из избранного: {len(removed)}')
+
+    return redirect(redirect_to)
+
+UPLOAD_READ_SIZE = 64 * 1024
+SHA256_RE = re.compile(r'^[0-9a-f]{64}$')
+
+def _upload_gone(upload):
+    """Временный файл удалили (например, gc_media): загрузку можно только начать заново"""
+    upload.delete()
+    return JsonResponse({'error': 'Временный файл загрузки удален, начните загрузку заново'}, status=410)
+
+def _upload_state(upload):
+    return {
+        'upload_id': str(upload.upload_id),
+        'offset': upload.offset,
+        'total_size': upload.total_size,
+        'status': upload.status,
+        'chunk_size': settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE,
+    }
+
+@staff_member_required
+@require_POST
+def upload_start(request):
+    """Начинает загрузку файла книги по частям или возвращает незавершенную"""
+    book = get_object_or_404(Book, pk=request.POST.get('book'))
+    filename = os.path.basename(request.POST.get('filename', ''))
+    checksum = request.POST.get('sha256', '').lower()
+    try:
+        total_size = int(request.POST.get('size', ''))
+    except ValueError:
+        total_size = -1
+    if not filename or total_size <= 0:
+        return JsonResponse({'error': 'Не указаны имя или размер файла'}, status=400)
+    if not SHA256_RE.match(checksum):
+        return JsonResponse({'error': 'Не указана контрольная сумма SHA-256 файла'}, status=400)
+
+    upload = ChunkedUpload.objects.filter(
+        user=request.user, book=book, filename=filename,
+        total_size=total_size, checksum=checksum,
+        status=ChunkedUpload.STATUS_UPLOADING,
+    ).order_by('-updated_at').first()
+
+    if upload is None or not os.path.exists(upload.temp_path):
+        upload = ChunkedUpload.objects.create(
+            user=request.user, book=book, filename=filename,
+            total_size=total_size, checksum=checksum,
+        )
+        os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+        open(upload.temp_path, 'wb').close()
+    else:
+        # Продолжаем с того места, которое действительно записано на диск
+        upload.offset = os.path.getsize(upload.temp_path)
+        upload.save(update_fields=['offset', 'updated_at'])
+
+    return JsonResponse(_upload_state(upload))
+
+@staff_member_required
+@require_http_methods(['GET', 'POST'])
+def upload_chunk(request, upload_id):
+    """Дописывает часть файла потоком прямо во временный файл
+
+    Тело запроса - байты части, заголовок X-Upload-Offset - позиция,
+    с которой она начинается, X-Chunk-Sha256 - контрольная сумма части.
+    """
+    upload = get_object_or_404(ChunkedUpload, upload_id=upload_id, user=request.user)
+    if request.method == 'GET' or upload.status != ChunkedUpload.STATUS_UPLOADING:
+        return JsonResponse(_upload_state(upload))
+
+    try:
+        offset = int(request.headers.get('X-Upload-Offset', ''))
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return JsonResponse({'error': 'Некорректное смещение'}, status=400)
+    if offset != upload.offset:
+        return JsonResponse(_upload_state(upload), status=409)
+    expected = request.headers.get('X-Chunk-Sha256', '').lower()
+    if not SHA256_RE.match(expected):
+        return JsonResponse(dict(_upload_state(upload), error='Не указана контрольная сумма части'), status=400)
+    if length <= 0 or length > settings.CHUNKED_UPLOAD_MAX_CHUNK_SIZE \
+            or offset + length > upload.total_size:
+        return JsonResponse({'error': 'Некорректный размер части'}, status=400)
+
+    hasher = hashlib.sha256()
+    try:
+        temp_file = open(upload.temp_path, 'r+b')
+    except FileNotFoundError:
+        return _upload_gone(upload)
+    with temp_file:
+        temp_file.seek(offset)
+        remaining = length
+        while remaining:
+            data = request.read(min(UPLOAD_READ_SIZE, remaining))
+            if not data:
+                break
+            hasher.update(data)
+            temp_file.write(data)
+            remaining -= len(data)
+
+        if remaining or expected != hasher.hexdigest():
+            temp_file.truncate(offset)
+            return JsonResponse(
+                dict(_upload_state(upload), error='Часть повреждена, отправьте ее повторно'),
+                status=400,
+            )
+        temp_file.truncate(offset + length)
+
+    updated = ChunkedUpload.objects.filter(pk=upload.pk, offset=offset).update(
+        offset=offset + length, updated_at=timezone.now(),
+    )
+    if not updated:
+        upload.refresh_from_db()
+        return JsonResponse(_upload_state(upload), status=409)
+    upload.offset = offset + length
+    return JsonResponse(_upload_state(upload))
+
+@staff_member_required
+@require_POST
+def upload_complete(request, upload_id):
+    """Переносит загруженный файл в хранилище и проверяет его SHA-256"""
+    upload = get_object_or_404(
+        ChunkedUpload, upload_id=upload_id, user=request.user,
+        status=ChunkedUpload.STATUS_UPLOADING,
+    )
+    try:
+        temp_file = open(upload.temp_path, 'rb')
+    except FileNotFoundError:
+        return _upload_gone(upload)
+    if upload.offset != upload.total_size or os.fstat(temp_file.fileno()).st_size != upload.total_size:
+        temp_file.close()
+        return JsonResponse(dict(_upload_state(upload), error='Файл загружен не полностью'), status=409)
+
+    hasher = hashlib.sha256()
+    with temp_file:
+        for block in iter(lambda: temp_file.read(UPLOAD_READ_SIZE), b''):
+            hasher.update(block)
+        digest = hasher.hexdigest()
+        if upload.checksum != digest:
+            temp_file.close()
+            os.remove(upload.temp_path)
+            upload.delete()
+            return JsonResponse({'error': 'Контрольная сумма файла не совпала', 'sha256': digest}, status=400)
+
+        # Файл сохраняется через поле книги, чтобы при гонке с удалением его
+        # можно было записать заново из того же содержимого
+        book = upload.book
+        book.book_file = File(temp_file, upload.filename)
+        book.save(update_fields=['book_file'])
+
+    os.remove(upload.temp_path)
+    upload.checksum = digest
+    upload.status = ChunkedUpload.STATUS_COMPLETE
+    upload.save(update_fields=['checksum', 'status', 'updated_at'])
+    return JsonResponse(dict(_upload_state(upload), sha256=digest, url=book.book_file.url))
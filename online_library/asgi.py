@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'online_library.settings')
 
 application = get_asgi_application()
+
+# Индекс подсказок поиска строится при старте процесса, а не на первом запросе
+from library.autocomplete import warm_up  # noqa: E402
+
+warm_up()
+
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/3.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -47,6 +48,7 @@ MIDDLEWARE = [
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    'library.ratelimit.RateLimitMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
@@ -82,6 +84,57 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Страницы для анонимов можно держать в памяти каждого процесса: их ключи
+# содержат версию каталога, а она хранится в общем файле CATALOG_VERSION_PATH.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+CATALOG_PAGE_CACHE_TIMEOUT = 60 * 60
+
+# Версия каталога, общая для всех процессов сервера и команд управления
+CATALOG_VERSION_PATH = os.path.join(BASE_DIR, 'tmp', 'catalog.version')
+
+# Снимок жанров, авторов и книг, который процессы читают через mmap
+CATALOG_SNAPSHOT_PATH = os.path.join(BASE_DIR, 'tmp', 'catalog.snapshot')
+
+
+# Ограничение частоты запросов по имени URL: "N/s", "N/m", "N/h" или "N/d"
+# на каждый IP и каждого пользователя. lease - сколько токенов процесс
+# забирает из общего кэша за одно обращение.
+
+RATELIMITS = {
+    'toggle_favorite': {'rate': '60/m'},
+    'favorites_batch': {'rate': '20/m'},
+    'login': {'rate': '10/m', 'methods': ['POST']},
+    'register': {'rate': '5/m', 'methods': ['POST']},
+}
+
+# Счетчики лимитов должны быть общими для всех процессов и увеличиваться
+# атомарно, поэтому для них нужен Memcached (pip install pymemcache) по адресу
+# из MEMCACHED_LOCATION. Кэш в памяти процесса годится только для одного
+# процесса (runserver, тесты); без DEBUG с ним сервер не запустится.
+
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES['ratelimit'] = {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': os.environ['MEMCACHED_LOCATION'],
+    }
+else:
+    CACHES['ratelimit'] = {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ratelimit',
+    }
+
+RATELIMIT_CACHE = 'ratelimit'
+RATELIMIT_ALLOW_LOCAL_CACHE = DEBUG
+
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -125,6 +178,16 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-import os
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Загрузка файлов книг по частям
+CHUNKED_UPLOAD_DIR = os.path.join(BASE_DIR, 'tmp', 'uploads')
+CHUNKED_UPLOAD_MAX_CHUNK_SIZE = 8 * 1024 * 1024
+# Незавершенную загрузку, в которую столько секунд не приходили части, удаляет gc_media
+CHUNKED_UPLOAD_EXPIRY = 24 * 60 * 60
+
+# Подготовка PDF: линеаризация и картинки первых страниц
+PDF_PROCESS_IN_BACKGROUND = True
+PDF_PREVIEW_PAGES = 3
+PDF_PREVIEW_SCALE = 1.5
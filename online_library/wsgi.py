@@ -14,3 +14,9 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'online_library.settings')
 
 application = get_wsgi_application()
+
+# Индекс подсказок поиска строится при старте процесса, а не на первом запросе
+from library.autocomplete import warm_up  # noqa: E402
+
+warm_up()
+